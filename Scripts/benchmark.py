@@ -0,0 +1,453 @@
+### Benchmarks of the data and training hot paths on synthetic ReClor data with tiny random models, runnable on CPU
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+import transformers
+from torch.utils.data import DataLoader, RandomSampler
+from transformers import AdamW, RobertaTokenizer, RobertaTokenizerFast
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+import main_large
+import main_large_contrastive
+import utils_multiple_choice
+import utils_multiple_choice_contrastive
+from utils_training import concat_choice_groups, grouped_multiple_choice_loss, prefetch_to_device
+
+logger = logging.getLogger(__name__)
+
+WORDS = (
+    "if then all some no every only unless because therefore however since although the a of to in that is are was "
+    "were be not can must should would could may argument conclusion premise evidence assumption claim reasoning "
+    "scientist researcher city council company employee study survey result increase decrease price market policy "
+    "law government student teacher school test score plant animal species population water energy health doctor "
+    "patient treatment drug effect cause reason likely unlikely most least strongly weaken strengthen support flaw"
+).split()
+
+QUESTION_TYPES = ["Identify the flaw", "Must be true or Cannot be true", "Parallel principle", "Weaken", "Strengthen"]
+
+
+def init_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON to this file instead of stdout")
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help="Results of an earlier run to compare with, every result gets its ratio to the baseline time",
+    )
+    parser.add_argument(
+        "--max_slowdown",
+        type=float,
+        default=0.0,
+        help="With --baseline: exit with an error if a benchmark takes more than this many times its baseline time",
+    )
+    parser.add_argument(
+        "--benchmarks",
+        type=str,
+        default="processor,convert,load_and_cache,steps",
+        help="Comma-separated groups of benchmarks to run",
+    )
+    parser.add_argument("--repeats", type=int, default=3, help="Runs of every benchmark, the median time is reported")
+    parser.add_argument("--num_examples", type=int, default=200, help="Number of synthetic examples per split")
+    parser.add_argument("--max_seq_length", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--train_steps", type=int, default=10, help="Training steps timed per run")
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--num_hidden_layers", type=int, default=2)
+    parser.add_argument("--num_attention_heads", type=int, default=2)
+    parser.add_argument("--intermediate_size", type=int, default=128)
+    parser.add_argument("--threads", type=int, default=0, help="Intra-op threads, 0 for the torch default")
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+def random_text(rng, min_words, max_words):
+    words = rng.choice(WORDS, size=rng.randint(min_words, max_words + 1))
+    return " ".join(words).capitalize() + "."
+
+
+def write_synthetic_data(data_dir, num_examples, seed):
+    """
+    Writes train, val and test splits of ``num_examples`` random examples in the ReClor format, with the question
+    types and the extended and negative contexts that the processors read (versions 1 and 91).
+    """
+    rng = np.random.RandomState(seed)
+    for split in ["train", "val", "test"]:
+        examples = [
+            {
+                "context": random_text(rng, 60, 180),
+                "question": random_text(rng, 8, 20),
+                "answers": [random_text(rng, 10, 40) for _ in range(4)],
+                "label": int(rng.randint(4)),
+                "id_string": "{}_{}".format(split, index),
+            }
+            for index in range(num_examples)
+        ]
+        with open(os.path.join(data_dir, split + ".json"), "w") as f:
+            json.dump(examples, f)
+        np.save(os.path.join(data_dir, split + "_ques_types.npy"), np.array(rng.choice(QUESTION_TYPES, num_examples)))
+        np.save(
+            os.path.join(data_dir, split + "_extended_context_cp_v1.npy"),
+            np.array([[random_text(rng, 5, 25) for _ in range(4)] for _ in range(num_examples)]),
+        )
+        np.save(
+            os.path.join(data_dir, split + "_extended_context_cp_v91.npy"),
+            np.array([[random_text(rng, 5, 25)] for _ in range(num_examples)]),
+        )
+        np.save(
+            os.path.join(data_dir, split + "_negative_context_cp_v1.npy"),
+            np.array([[example["context"][::-1]] for example in examples]),
+        )
+
+
+def write_tokenizer(tokenizer_dir):
+    """
+    Writes a small byte-level BPE vocabulary in the format of RoBERTa: the byte symbols, plus merges that make
+    every word of the synthetic texts that follows a space one token. Other text falls back to bytes.
+    """
+    vocab = ["<s>", "<pad>", "</s>", "<unk>", "<mask>"] + list(bytes_to_unicode().values())
+    merges = []
+    space = bytes_to_unicode()[ord(" ")]
+    for word in WORDS:
+        token = space
+        for char in word:
+            if token + char not in vocab:
+                merges.append("{} {}".format(token, char))
+                vocab.append(token + char)
+            token += char
+    with open(os.path.join(tokenizer_dir, "vocab.json"), "w") as f:
+        json.dump({token: index for index, token in enumerate(vocab)}, f)
+    with open(os.path.join(tokenizer_dir, "merges.txt"), "w") as f:
+        f.write("\n".join(["#version: 0.2"] + merges) + "\n")
+
+
+def load_tokenizer(tokenizer_dir, fast=False):
+    tokenizer = (RobertaTokenizerFast if fast else RobertaTokenizer).from_pretrained(tokenizer_dir)
+    tokenizer.add_special_tokens({"additional_special_tokens": ["<ext>"]})
+    return tokenizer
+
+
+def main_args(module, data_dir, tokenizer_dir, model_type, bench_args, extra=()):
+    """ Arguments of a main script for the benchmark data and model """
+    return module.init_args(
+        [
+            "--data_dir", data_dir,
+            "--model_type", model_type,
+            "--model_name_or_path", tokenizer_dir,
+            "--task_name", "reclor",
+            "--output_dir", os.path.join(data_dir, "output"),
+            "--max_seq_length", str(bench_args.max_seq_length),
+            "--per_gpu_train_batch_size", str(bench_args.batch_size),
+            "--per_gpu_eval_batch_size", str(bench_args.batch_size),
+            "--whether_extend_context",
+            "--negative_entend_context_version", "91",
+            "--seed", str(bench_args.seed),
+            "--no_cuda",
+        ]
+        + list(extra)
+    )
+
+
+def build_model(model_type, tokenizer, bench_args):
+    config_class, model_class = main_large.MODEL_CLASSES[model_type][:2]
+    config = config_class(
+        vocab_size=len(tokenizer),
+        hidden_size=bench_args.hidden_size,
+        num_hidden_layers=bench_args.num_hidden_layers,
+        num_attention_heads=bench_args.num_attention_heads,
+        intermediate_size=bench_args.intermediate_size,
+        max_position_embeddings=bench_args.max_seq_length + tokenizer.pad_token_id + 1,
+        pad_token_id=tokenizer.pad_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    if model_type == "albert":
+        config.embedding_size = bench_args.hidden_size // 2
+    return model_class(config)
+
+
+def time_runs(fn, repeats, setup=None):
+    """ Runs ``fn`` ``repeats`` times after ``setup`` and returns the times in seconds """
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def result(name, times, items, unit):
+    median = statistics.median(times)
+    return {
+        "name": name,
+        "seconds": median,
+        "min_seconds": min(times),
+        "max_seconds": max(times),
+        "repeats": len(times),
+        "items": items,
+        "unit": unit,
+        "items_per_second": items / median if median > 0 else None,
+    }
+
+
+def bench_processors(data_dir, tokenizer_dir, bench_args):
+    results = []
+    processor = utils_multiple_choice.ReclorProcessor()
+    times = time_runs(lambda: processor.get_train_examples(data_dir, 1), bench_args.repeats)
+    results.append(result("processor/plain", times, bench_args.num_examples, "examples"))
+    processor = utils_multiple_choice_contrastive.ReclorProcessor()
+    times = time_runs(lambda: processor.get_train_examples(data_dir, 1, 1, 91), bench_args.repeats)
+    results.append(result("processor/contrastive", times, bench_args.num_examples, "examples"))
+    return results
+
+
+def bench_convert(data_dir, tokenizer_dir, bench_args):
+    results = []
+    for name, module, examples in [
+        ("plain", utils_multiple_choice, utils_multiple_choice.ReclorProcessor().get_train_examples(data_dir, 1)),
+        (
+            "contrastive",
+            utils_multiple_choice_contrastive,
+            utils_multiple_choice_contrastive.ReclorProcessor().get_train_examples(data_dir, 1, 1, 91),
+        ),
+    ]:
+        for fast in [False, True]:
+            tokenizer = load_tokenizer(tokenizer_dir, fast)
+            times = time_runs(
+                lambda: module.convert_examples_to_features(
+                    examples,
+                    module.ReclorProcessor().get_labels(),
+                    bench_args.max_seq_length,
+                    tokenizer,
+                    whether_extend_context=True,
+                    batch_size=1000 if fast else 0,
+                ),
+                bench_args.repeats,
+            )
+            results.append(
+                result(
+                    "convert/{}/{}".format(name, "fast" if fast else "slow"), times, len(examples), "examples"
+                )
+            )
+    return results
+
+
+def bench_load_and_cache(data_dir, tokenizer_dir, bench_args):
+    results = []
+    tokenizer = load_tokenizer(tokenizer_dir)
+
+    def remove_caches():
+        for name in os.listdir(data_dir):
+            if name.startswith("cached_"):
+                shutil.rmtree(os.path.join(data_dir, name))
+
+    for name, module in [("plain", main_large), ("contrastive", main_large_contrastive)]:
+        args = main_args(module, data_dir, tokenizer_dir, "roberta", bench_args)
+        load = lambda: module.load_and_cache_examples(args, "reclor", tokenizer)
+        times = time_runs(load, bench_args.repeats, setup=remove_caches)
+        results.append(result("load_and_cache/{}/cold".format(name), times, bench_args.num_examples, "examples"))
+        times = time_runs(load, bench_args.repeats)
+        results.append(result("load_and_cache/{}/warm".format(name), times, bench_args.num_examples, "examples"))
+    remove_caches()
+    return results
+
+
+def train_batches(dataset, bench_args, args, module):
+    dataloader = DataLoader(
+        dataset,
+        sampler=RandomSampler(dataset, generator=torch.Generator().manual_seed(bench_args.seed)),
+        batch_size=bench_args.batch_size,
+    )
+    batches = []
+    while len(batches) < bench_args.train_steps + 1:
+        batches.extend(prefetch_to_device(dataloader, args.device, module.unused_fields(args)))
+    return batches[:bench_args.train_steps + 1]
+
+
+def train_step_fn(model, optimizer, batches, fused=None):
+    """
+    Returns a function running a training step on every batch as ``train()`` does: the forward and backward pass,
+    gradient clipping and the optimizer step. ``fused`` is None for the plain model, and otherwise selects the fused
+    or the separate forward pass of the contrastive choices.
+    """
+
+    def step(batch):
+        inputs = {"input_ids": batch[0], "attention_mask": batch[1], "token_type_ids": batch[2], "labels": batch[3]}
+        if fused:
+            outputs = model(
+                input_ids=concat_choice_groups([batch[0], batch[4]], model.config.pad_token_id),
+                attention_mask=concat_choice_groups([batch[1], batch[5]]),
+                token_type_ids=concat_choice_groups([batch[2], batch[6]]) if batch[2] is not None else None,
+            )
+            loss, _ = grouped_multiple_choice_loss(
+                outputs[0], [batch[3], batch[7]], [batch[0].size(1), batch[4].size(1)]
+            )
+            loss.backward()
+        else:
+            model(**inputs)[0].backward()
+            if fused is not None:
+                inputs = {"input_ids": batch[4], "attention_mask": batch[5], "token_type_ids": batch[6], "labels": batch[7]}
+                model(**inputs)[0].backward()
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        optimizer.step()
+        model.zero_grad()
+
+    def run():
+        for batch in batches:
+            step(batch)
+
+    return run
+
+
+def bench_steps(data_dir, tokenizer_dir, bench_args):
+    results = []
+    tokenizer = load_tokenizer(tokenizer_dir)
+    for model_type in ["roberta", "albert"]:
+        for name, module, variants in [
+            ("plain", main_large, [None]),
+            ("contrastive", main_large_contrastive, [False, True]),
+        ]:
+            args = main_args(module, data_dir, tokenizer_dir, model_type, bench_args)
+            args.device = torch.device("cpu")
+            args.n_gpu = 0
+            args.amp_dtype = None
+            dataset = module.load_and_cache_examples(args, "reclor", tokenizer)
+            batches = train_batches(dataset, bench_args, args, module)
+            for fused in variants:
+                torch.manual_seed(bench_args.seed)
+                model = build_model(model_type, tokenizer, bench_args)
+                model.train()
+                optimizer = AdamW(model.parameters(), lr=1e-5)
+                # the first step allocates the optimizer state and is not timed
+                train_step_fn(model, optimizer, batches[:1], fused)()
+                times = time_runs(train_step_fn(model, optimizer, batches[1:], fused), bench_args.repeats)
+                variant = name if fused is None else "{}_{}".format(name, "fused" if fused else "separate")
+                results.append(
+                    result(
+                        "train_step/{}/{}".format(model_type, variant),
+                        times,
+                        bench_args.train_steps * bench_args.batch_size,
+                        "examples",
+                    )
+                )
+
+            if name == "plain":
+                eval_dataset = module.load_and_cache_examples(args, "reclor", tokenizer, evaluate=True)
+                args.output_dir = tempfile.mkdtemp(dir=data_dir)
+                times = time_runs(lambda: module.evaluate(args, model, tokenizer, eval_dataset), bench_args.repeats)
+                results.append(result("evaluate/{}".format(model_type), times, len(eval_dataset), "examples"))
+    return results
+
+
+BENCHMARKS = {
+    "processor": bench_processors,
+    "convert": bench_convert,
+    "load_and_cache": bench_load_and_cache,
+    "steps": bench_steps,
+}
+
+
+def compare(results, baseline_file):
+    """ Adds the ratio of the time of every result to the time of the same benchmark in the baseline """
+    with open(baseline_file) as f:
+        baseline = {entry["name"]: entry for entry in json.load(f)["results"]}
+    for entry in results:
+        if entry["name"] in baseline:
+            entry["baseline_seconds"] = baseline[entry["name"]]["seconds"]
+            entry["slowdown"] = entry["seconds"] / entry["baseline_seconds"]
+
+
+def main():
+    bench_args = init_args()
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.WARN,
+    )
+    logger.setLevel(logging.INFO)
+    transformers.logging.set_verbosity_error()
+    if bench_args.threads > 0:
+        torch.set_num_threads(bench_args.threads)
+    random.seed(bench_args.seed)
+    np.random.seed(bench_args.seed)
+    torch.manual_seed(bench_args.seed)
+
+    selected = bench_args.benchmarks.split(",")
+    for name in selected:
+        if name not in BENCHMARKS:
+            raise ValueError("Unknown benchmark group {}, choose from {}".format(name, ", ".join(BENCHMARKS)))
+    work_dir = tempfile.mkdtemp(prefix="lreasoner_benchmark_")
+    try:
+        data_dir = os.path.join(work_dir, "data")
+        tokenizer_dir = os.path.join(work_dir, "tokenizer")
+        os.makedirs(data_dir)
+        os.makedirs(tokenizer_dir)
+        write_synthetic_data(data_dir, bench_args.num_examples, bench_args.seed)
+        write_tokenizer(tokenizer_dir)
+
+        results = []
+        # the processors print progress, which must not end up in the JSON on stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            for name in selected:
+                logger.info("Running %s benchmarks", name)
+                results.extend(BENCHMARKS[name](data_dir, tokenizer_dir, bench_args))
+    finally:
+        shutil.rmtree(work_dir)
+
+    if bench_args.baseline:
+        compare(results, bench_args.baseline)
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "threads": torch.get_num_threads(),
+        },
+        "config": {
+            key: value
+            for key, value in vars(bench_args).items()
+            if key not in ["output", "baseline", "max_slowdown", "benchmarks"]
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if bench_args.output:
+        with open(bench_args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    for entry in results:
+        logger.info(
+            "%-45s %10.4f s  %10.1f %s/s%s",
+            entry["name"],
+            entry["seconds"],
+            entry["items_per_second"] or 0.0,
+            entry["unit"],
+            "  x{:.2f} baseline".format(entry["slowdown"]) if "slowdown" in entry else "",
+        )
+    if bench_args.max_slowdown > 0:
+        regressions = [entry["name"] for entry in results if entry.get("slowdown", 0.0) > bench_args.max_slowdown]
+        if regressions:
+            logger.error("Slower than the baseline by more than x%s: %s", bench_args.max_slowdown, ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,16 @@
 ### The baseline+DA(data augmentation algorithm) and baseline+DA+CE(context extension framework) models
 
 import argparse
+import copy
+import functools
+import itertools
 import logging
 import os
 import random
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data import DataLoader, IterableDataset, RandomSampler
 from torch.utils.data.distributed import DistributedSampler
 
 from transformers import (
@@ -16,18 +19,59 @@ from transformers import (
     BertConfig,
     BertForMultipleChoice,
     BertTokenizer,
+    BertTokenizerFast,
     RobertaConfig,
     RobertaForMultipleChoice,
     RobertaTokenizer,
+    RobertaTokenizerFast,
     XLNetConfig,
     XLNetForMultipleChoice,
     XLNetTokenizer,
+    XLNetTokenizerFast,
     AlbertConfig,
     AlbertForMultipleChoice,
     AlbertTokenizer,
+    AlbertTokenizerFast,
     get_linear_schedule_with_warmup,
 )
-from utils_multiple_choice_contrastive import convert_examples_to_features, processors
+from utils_multiple_choice_contrastive import (
+    convert_examples_to_features,
+    feature_cache_key,
+    get_feature_shards,
+    load_feature_arrays,
+    processors,
+    save_feature_arrays,
+    save_feature_shards,
+)
+from utils_packing import PackedMultipleChoiceModel
+from utils_training import (
+    AsyncEvaluator,
+    CheckpointWriter,
+    DynamicPaddingCollator,
+    EvaluationEngine,
+    FeatureDataset,
+    LengthGroupedBatchSampler,
+    PredictionAccumulator,
+    StepStats,
+    StreamingFeatureDataset,
+    autocast,
+    bind_cpu_rank,
+    dataloader_options,
+    enable_gradient_checkpointing,
+    get_rng_state,
+    grad_scaler,
+    gradient_sync,
+    load_training_args,
+    load_training_state,
+    peak_memory_mb,
+    peak_memory_name,
+    prefetch_to_device,
+    set_rng_state,
+    step_profiler,
+    write_checkpoint,
+    concat_choice_groups,
+    grouped_multiple_choice_loss,
+)
 
 try:
     from torch.utils.tensorboard import SummaryWriter
@@ -43,7 +87,39 @@ MODEL_CLASSES = {
     "albert": (AlbertConfig, AlbertForMultipleChoice, AlbertTokenizer),
 }
 
-def init_args():
+FAST_TOKENIZER_CLASSES = {
+    "bert": BertTokenizerFast,
+    "xlnet": XLNetTokenizerFast,
+    "roberta": RobertaTokenizerFast,
+    "albert": AlbertTokenizerFast,
+}
+
+# columns of the feature cache, in the order of the tensors of the dataset
+FEATURE_FIELDS = (
+    "input_ids",
+    "input_mask",
+    "segment_ids",
+    "label_ids",
+    "contras_input_ids",
+    "contras_input_mask",
+    "contras_segment_ids",
+    "contras_label_ids",
+)
+
+# compact on-disk and in-memory dtypes of the feature columns, widened to int64 on the device per batch
+FEATURE_DTYPES = {
+    "input_ids": np.int32,
+    "input_mask": np.uint8,
+    "segment_ids": np.uint8,
+    "label_ids": np.int64,
+    "contras_input_ids": np.int32,
+    "contras_input_mask": np.uint8,
+    "contras_segment_ids": np.uint8,
+    "contras_label_ids": np.int64,
+    "lengths": np.int32,
+}
+
+def init_args(argv=None):
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -111,13 +187,28 @@ def init_args():
     parser.add_argument(
         "--evaluate_during_training", action="store_true", help="Run evaluation during training at each logging step."
     )
+    parser.add_argument(
+        "--async_eval",
+        action="store_true",
+        help="Evaluate snapshots of the weights in a background process during training instead of pausing training",
+    )
+    parser.add_argument(
+        "--eval_device",
+        type=str,
+        default=None,
+        help="Device of the background evaluation with --async_eval, e.g. cuda:1 or cpu (default: the training device)",
+    )
     parser.add_argument(
         "--do_lower_case", action="store_true", help="Set this flag if you are using an uncased model."
     )
 
     parser.add_argument("--per_gpu_train_batch_size", default=8, type=int, help="Batch size per GPU/CPU for training.")
     parser.add_argument(
-        "--per_gpu_eval_batch_size", default=8, type=int, help="Batch size per GPU/CPU for evaluation."
+        "--per_gpu_eval_batch_size",
+        default=0,
+        type=int,
+        help="Batch size per GPU/CPU for evaluation, 0 to size it automatically to the memory of the GPU, or to 8192 "
+        "tokens per batch on CPU",
     )
     parser.add_argument(
         "--gradient_accumulation_steps",
@@ -130,6 +221,12 @@ def init_args():
     parser.add_argument('--adam_betas', default='(0.9, 0.999)', type=str, help='betas for Adam optimizer')
     parser.add_argument("--adam_epsilon", default=1e-8, type=float, help="Epsilon for Adam optimizer.")
     parser.add_argument("--no_clip_grad_norm", action="store_true", help="whether not to clip grad norm")
+    parser.add_argument(
+        "--fused_contrastive_forward",
+        action="store_true",
+        help="Score the original and the contrastive choices in one forward pass with one backward pass and one gradient "
+             "clipping, required for distributed training",
+    )
     parser.add_argument("--max_grad_norm", default=1.0, type=float, help="Max gradient norm.")
     parser.add_argument(
         "--num_train_epochs", default=3.0, type=float, help="Total number of training epochs to perform."
@@ -144,7 +241,19 @@ def init_args():
     parser.add_argument("--warmup_proportion", default=0.0, type=float, help="Linear warmup over warmup ratios.")
 
     parser.add_argument("--logging_steps", type=int, default=50, help="Log every X updates steps.")
-    parser.add_argument("--save_steps", type=int, default=50, help="Save checkpoint every X updates steps.")
+    parser.add_argument(
+        "--save_steps",
+        type=int,
+        default=0,
+        help="Save a resumable training state (weights, optimizer, scheduler, loss scaler and random states) into "
+        "<output_dir>_state every X updates steps, 0 to not save it.",
+    )
+    parser.add_argument(
+        "--resume_from",
+        type=str,
+        default=None,
+        help="Training state directory written with --save_steps to continue training from",
+    )
     parser.add_argument(
         "--eval_all_checkpoints",
         action="store_true",
@@ -155,14 +264,120 @@ def init_args():
         "--overwrite_output_dir", action="store_true", help="Overwrite the content of the output directory"
     )
     parser.add_argument(
-        "--overwrite_cache", action="store_true", help="Overwrite the cached training and evaluation sets"
+        "--overwrite_cache",
+        action="store_true",
+        help="Overwrite the cached training and evaluation sets. Not needed to pick up changed data, flags or "
+             "tokenizer, which give a new cache key",
     )
     parser.add_argument("--seed", type=int, default=42, help="random seed for initialization")
+    parser.add_argument(
+        "--fast_tokenizer",
+        action="store_true",
+        help="Use the Rust-backed fast tokenizer and encode all text pairs of a split in batches",
+    )
+    parser.add_argument(
+        "--tokenize_batch_size",
+        type=int,
+        default=1000,
+        help="Number of text pairs per tokenizer call when --fast_tokenizer is set",
+    )
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        help="Batch examples of similar length together and pad every batch only to its longest choice",
+    )
+    parser.add_argument(
+        "--preprocessing_num_workers",
+        type=int,
+        default=1,
+        help="Number of processes used to convert examples to features",
+    )
+    parser.add_argument(
+        "--dataloader_num_workers",
+        type=int,
+        default=0,
+        help="Number of DataLoader worker processes that prepare batches in the background, kept alive across epochs",
+    )
+    parser.add_argument(
+        "--dataloader_prefetch_factor",
+        type=int,
+        default=2,
+        help="Number of batches every DataLoader worker prepares in advance",
+    )
+    parser.add_argument(
+        "--no_pin_memory",
+        action="store_true",
+        help="Do not put the batches into pinned memory for asynchronous copies to the GPU",
+    )
+    parser.add_argument(
+        "--log_step_stats",
+        action="store_true",
+        help="Time the data loading, forward, backward, optimizer and evaluation phases of the training steps and "
+             "log them with the throughput to TensorBoard and to step_stats.jsonl in the summaries directory",
+    )
+    parser.add_argument(
+        "--peak_tflops",
+        type=float,
+        default=0.0,
+        help="Peak TFLOPS of a device, to report the model FLOPs utilization with --log_step_stats",
+    )
+    parser.add_argument(
+        "--profile_start_step",
+        type=int,
+        default=0,
+        help="Number of training steps (or of evaluation batches, without --do_train) before the --profile_steps window",
+    )
+    parser.add_argument(
+        "--profile_steps",
+        type=int,
+        default=0,
+        help="Record this many steps with torch.profiler and write the trace next to the TensorBoard summaries",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Cache the training features in shards and stream them from disk instead of indexing them in memory",
+    )
+    parser.add_argument(
+        "--stream_shard_size",
+        type=int,
+        default=10000,
+        help="Number of examples per shard of the training cache when --streaming is set",
+    )
+    parser.add_argument(
+        "--shuffle_buffer_size",
+        type=int,
+        default=10000,
+        help="Number of examples in the shuffle buffer of every DataLoader worker when --streaming is set",
+    )
+    parser.add_argument(
+        "--pack_sequences",
+        action="store_true",
+        help="Pack several choices into one row with block-diagonal attention in training and evaluation "
+        "(bert, roberta and albert only)",
+    )
+    parser.add_argument(
+        "--gradient_checkpointing",
+        action="store_true",
+        help="Recompute encoder activations in the backward pass instead of keeping them, to fit larger batches",
+    )
+    parser.add_argument(
+        "--gradient_checkpointing_every",
+        type=int,
+        default=1,
+        help="Checkpoint every N-th encoder layer when --gradient_checkpointing is set; 1 saves the most memory, "
+        "larger values recompute less",
+    )
 
     parser.add_argument(
         "--fp16",
         action="store_true",
-        help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit",
+        help="Whether to use 16-bit (mixed) precision (through torch autocast) instead of 32-bit, on GPU only",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="Whether to use bfloat16 mixed precision (through torch autocast) instead of 32-bit, also on CPU",
     )
     parser.add_argument(
         "--ques_type_before",
@@ -171,13 +386,22 @@ def init_args():
         help="Whether to place question type before question",
     )
     parser.add_argument(
-        "--fp16_opt_level",
+        "--local_rank", "--local-rank", type=int, default=-1, help="For distributed training: local_rank"
+    )
+    parser.add_argument(
+        "--cpu_binding",
         type=str,
-        default="O1",
-        help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-             "See details at https://nvidia.github.io/apex/amp.html",
+        default="cores",
+        choices=["cores", "numa", "none"],
+        help="For distributed training on CPU (with --no_cuda or without GPUs): pin every process to its own block "
+             "of cores, to whole NUMA nodes, or not at all",
+    )
+    parser.add_argument(
+        "--cpu_threads_per_rank",
+        type=int,
+        default=0,
+        help="For distributed training on CPU: intra-op threads of every process, 0 for one per core of the process",
     )
-    parser.add_argument("--local_rank", type=int, default=-1, help="For distributed training: local_rank")
     parser.add_argument("--server_ip", type=str, default="", help="For distant debugging.")
     parser.add_argument("--server_port", type=str, default="", help="For distant debugging.")
 
@@ -208,7 +432,7 @@ def init_args():
         help="The version of negative entend context",
     )
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 def set_seed(args):
@@ -219,12 +443,6 @@ def set_seed(args):
         torch.cuda.manual_seed_all(args.seed)
 
 
-def select_field(features, field):
-    return [[choice[field] for choice in feature.choices_features] for feature in features]
-
-def select_contras_field(features, field):
-    return [[choice[field] for choice in feature.contras_choices_features] for feature in features]
-
 def simple_accuracy(preds, labels):
     return (preds == labels).mean()
 
@@ -242,19 +460,46 @@ def load_and_cache_examples(args, task, tokenizer, evaluate=False, test=False):
     else:
         cached_mode = "train"
     assert not (evaluate and test)
+    # only the training set is streamed, the dev and test sets are small enough to be indexed
+    streaming = args.streaming and cached_mode == "train"
+    # the cache is named after a hash of the data files, the conversion arguments and the tokenizer, so a cache
+    # that exists always matches the current run
+    data_files = processor.get_data_files(
+        args.data_dir,
+        cached_mode,
+        args.extended_context_version,
+        args.negative_context_version,
+        args.negative_entend_context_version,
+    )
+    cache_key = feature_cache_key(
+        data_files,
+        tokenizer,
+        fields=FEATURE_FIELDS + ("lengths",),
+        dtypes={field: np.dtype(dtype).name for field, dtype in FEATURE_DTYPES.items()},
+        task=task,
+        model_type=args.model_type,
+        max_seq_length=args.max_seq_length,
+        stream_shard_size=args.stream_shard_size if streaming else 0,
+        ques_type_before=args.ques_type_before,
+        whether_extend_context=args.whether_extend_context,
+        extended_context_version=args.extended_context_version,
+        negative_context_version=args.negative_context_version,
+        negative_entend_context_version=args.negative_entend_context_version,
+    )
     cached_features_file = os.path.join(
         args.data_dir,
-        "cached_{}_{}_{}_{}_contras_extn".format(
+        "cached_{}_{}_{}_{}_contras_extn_{}".format(
             cached_mode,
             list(filter(None, args.model_name_or_path.split("/"))).pop(),
             str(args.max_seq_length),
             str(task),
+            cache_key,
         ),
     )
 
-    if os.path.exists(cached_features_file) and not args.overwrite_cache:
+    # the other processes in distributed training always use the cache the first process has just written
+    if os.path.isdir(cached_features_file) and (not args.overwrite_cache or args.local_rank not in [-1, 0]):
         logger.info("Loading features from cached file %s", cached_features_file)
-        features = torch.load(cached_features_file)
     else:
         logger.info("Creating features from dataset file at %s", args.data_dir)
         label_list = processor.get_labels()
@@ -265,49 +510,136 @@ def load_and_cache_examples(args, task, tokenizer, evaluate=False, test=False):
         else:
             examples = processor.get_train_examples(args.data_dir, args.extended_context_version, args.negative_context_version, args.negative_entend_context_version)
         logger.info("Training number: %s", str(len(examples)))
-        features = convert_examples_to_features(
-            examples,
-            label_list,
-            args.max_seq_length,
-            tokenizer,
+        convert = functools.partial(
+            convert_examples_to_features,
+            label_list=label_list,
+            max_length=args.max_seq_length,
+            tokenizer=tokenizer,
             ques_type_before=args.ques_type_before,
             pad_on_left=bool(args.model_type in ["xlnet"]),  # pad on the left for xlnet
             pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
             whether_extend_context=args.whether_extend_context,
+            batch_size=args.tokenize_batch_size if args.fast_tokenizer else 0,
+            num_workers=args.preprocessing_num_workers,
+            dtypes=FEATURE_DTYPES,
         )
-        if args.local_rank in [-1, 0]:
-            logger.info("Saving features into cached file %s", cached_features_file)
-            torch.save(features, cached_features_file)
+        logger.info("Saving features into cached file %s", cached_features_file)
+        if streaming:
+            # convert and write one shard at a time, so the features never have to fit in memory at once
+            save_feature_shards(
+                cached_features_file,
+                (
+                    convert(examples[start:start + args.stream_shard_size])
+                    for start in range(0, len(examples), args.stream_shard_size)
+                ),
+                replace=args.overwrite_cache,
+            )
+        else:
+            save_feature_arrays(cached_features_file, convert(examples), replace=args.overwrite_cache)
 
     if args.local_rank == 0:
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-    # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor(select_field(features, "input_ids"), dtype=torch.long)
-    all_input_mask = torch.tensor(select_field(features, "input_mask"), dtype=torch.long)
-    all_segment_ids = torch.tensor(select_field(features, "segment_ids"), dtype=torch.long)
-    all_label_ids = torch.tensor([f.label for f in features], dtype=torch.long)
-
-    # augmented data
-    all_contras_input_ids = torch.tensor(select_contras_field(features, "contras_input_ids"), dtype=torch.long)
-    all_contras_input_mask = torch.tensor(select_contras_field(features, "contras_input_mask"), dtype=torch.long)
-    all_contras_segment_ids = torch.tensor(select_contras_field(features, "contras_segment_ids"), dtype=torch.long)
-    all_contras_label_ids = torch.tensor([f.contras_label for f in features], dtype=torch.long)
+    if streaming:
+        return StreamingFeatureDataset(
+            get_feature_shards(cached_features_file),
+            FEATURE_FIELDS,
+            shuffle_buffer_size=args.shuffle_buffer_size,
+            seed=args.seed,
+            batch_size=args.per_gpu_train_batch_size * max(1, args.n_gpu),
+        )
 
-    dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids, all_contras_input_ids, all_contras_input_mask, all_contras_segment_ids, all_contras_label_ids)
+    # Wrap the memory-mapped columns as Tensors and build dataset
+    arrays = load_feature_arrays(cached_features_file, FEATURE_FIELDS + ("lengths",))
+    dataset = FeatureDataset(*[torch.from_numpy(arrays[field]) for field in FEATURE_FIELDS], lengths=arrays["lengths"])
     return dataset
 
 
+def unused_fields(args):
+    """ Positions of the batch fields that the model does not use, XLM and RoBERTa have no segment ids """
+    if args.model_type in ["bert", "xlnet", "albert"]:
+        return ()
+    return tuple(index for index, field in enumerate(FEATURE_FIELDS) if field.endswith("segment_ids"))
+
+
+def summaries_dir(args):
+    """ TensorBoard directory of the run, which also gets its step stats and profiler traces """
+    return os.path.join('summaries', str(args.output_dir).split('/')[-1])
+
+
+def build_model(args, config):
+    """ Creates a model with random weights, e.g. to load the weights of a snapshot into """
+    model = MODEL_CLASSES[args.model_type][1](config)
+    if args.pack_sequences:
+        model = PackedMultipleChoiceModel(model)
+    return model
+
+
+def unwrap_model(model):
+    """ Returns the transformers model inside the parallel and packing wrappers """
+    model = model.module if hasattr(model, "module") else model  # Take care of distributed/parallel training
+    if isinstance(model, PackedMultipleChoiceModel):
+        model = model.model
+    return model
+
+
+def training_state_dir(args):
+    """ The resumable training state is kept next to args.output_dir, which is replaced by every best model """
+    return args.output_dir.rstrip(os.sep) + "_state"
+
+
+def save_model(args, tokenizer, model, global_step, results, checkpoint_writer=None):
+    """
+    Saves the best dev acc model with its tokenizer and training arguments into args.output_dir, in the
+    background if a checkpoint_writer is given
+    """
+    model_to_save = unwrap_model(model)
+    logger.info("Current local rank %s", args.local_rank)
+    files = {'best_dev_results.txt': 'global_steps: {}; dev_acc: {}'.format(global_step, results["eval_acc"])}
+    if checkpoint_writer is not None:
+        checkpoint_writer.save(args.output_dir, model_to_save, tokenizer, args, files)
+    else:
+        write_checkpoint(args.output_dir, model_to_save.config, model_to_save.state_dict(), tokenizer, args, files)
+    logger.info("Saving model checkpoint to %s", args.output_dir)
+
+
 def train(args, train_dataset, model, tokenizer, test_dataset=None):
     """ Train the model """
-    if args.local_rank in [-1, 0]:
-        str_list = str(args.output_dir).split('/')
-        tb_log_dir = os.path.join('summaries', str_list[-1])
+    if args.rank in [-1, 0]:
+        tb_log_dir = summaries_dir(args)
         tb_writer = SummaryWriter(tb_log_dir)
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    loader_options = dataloader_options(
+        args.dataloader_num_workers,
+        args.device.type == "cuda" and not args.no_pin_memory,
+        args.dataloader_prefetch_factor,
+        persistent_workers=True,
+    )
+    if isinstance(train_dataset, IterableDataset):
+        # a streaming dataset shuffles and shards itself
+        train_sampler = None
+        train_dataloader = DataLoader(
+            train_dataset,
+            batch_size=args.train_batch_size,
+            collate_fn=DynamicPaddingCollator(FEATURE_FIELDS, padding_side=tokenizer.padding_side)
+            if args.group_by_length
+            else None,
+            **loader_options
+        )
+    elif args.group_by_length:
+        train_sampler = LengthGroupedBatchSampler(train_dataset.lengths, args.train_batch_size, shuffle=True, seed=args.seed)
+        train_dataloader = DataLoader(
+            train_dataset,
+            batch_sampler=train_sampler,
+            collate_fn=DynamicPaddingCollator(FEATURE_FIELDS, padding_side=tokenizer.padding_side),
+            **loader_options
+        )
+    else:
+        train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
+        train_dataloader = DataLoader(
+            train_dataset, sampler=train_sampler, batch_size=args.train_batch_size, **loader_options
+        )
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -333,23 +665,54 @@ def train(args, train_dataset, model, tokenizer, test_dataset=None):
         optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=t_total
     )
 
-    if args.fp16:
-        try:
-            from apex import amp
-        except ImportError:
-            raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
-        model, optimizer = amp.initialize(model, optimizer, opt_level=args.fp16_opt_level)
+    # the weights stay in fp32 under autocast, only fp16 needs its loss scaled
+    scaler = grad_scaler(args.amp_dtype)
+
+    rank = torch.distributed.get_rank() if args.local_rank != -1 else 0
+    resume_state = None
+    if args.resume_from:
+        resume_state = load_training_state(args.resume_from)
+        if resume_state["amp_dtype"] != args.amp_dtype:
+            # the loss scaler only exists with fp16, and the optimizer state was built under this precision
+            raise ValueError(
+                "The training state {} was saved with mixed precision {}, the run continues with {}, use the same "
+                "--fp16/--bf16 flags".format(args.resume_from, resume_state["amp_dtype"], args.amp_dtype)
+            )
+        optimizer.load_state_dict(resume_state["optimizer"])
+        scheduler.load_state_dict(resume_state["scheduler"])
+        scaler.load_state_dict(resume_state["scaler"])
+        logger.info(
+            "Resuming training from %s at epoch %d, global step %d",
+            args.resume_from,
+            resume_state["epoch"],
+            resume_state["global_step"],
+        )
 
-    # multi-gpu training (should be after apex fp16 initialization)
+    # multi-gpu training
     if args.n_gpu > 1:
         model = torch.nn.DataParallel(model)
 
-    # Distributed training (should be after apex fp16 initialization)
+    # Distributed training
     if args.local_rank != -1:
+        # every parameter gets a gradient in each step except XLNet's mask_emb, which only two-stream attention uses,
+        # so the autograd graph does not need to be searched for unused parameters
         model = torch.nn.parallel.DistributedDataParallel(
-            model, device_ids=[args.local_rank], output_device=args.local_rank, find_unused_parameters=True
+            model,
+            device_ids=[args.local_rank] if args.device.type == "cuda" else None,
+            output_device=args.local_rank if args.device.type == "cuda" else None,
+            find_unused_parameters=args.model_type == "xlnet",
         )
 
+    memory_name = peak_memory_name(args.device)
+    step_stats = StepStats(
+        args.device,
+        unwrap_model(model).config,
+        tb_writer if args.rank in [-1, 0] else None,
+        os.path.join(tb_log_dir, "step_stats.jsonl") if args.rank in [-1, 0] else None,
+        args.peak_tflops * 1e12,
+        enabled=args.log_step_stats,
+    )
+
     # Train!
     logger.info("************************* Running training *************************")
     logger.info("Num examples = %d", len(train_dataset))
@@ -366,257 +729,364 @@ def train(args, train_dataset, model, tokenizer, test_dataset=None):
 
     val_dataset = load_and_cache_examples(args, args.task_name, tokenizer, evaluate=True, test=False)
 
-    def evaluate_model(train_preds, train_label_ids, tb_writer, args, model, tokenizer, best_steps, best_dev_acc, val_dataset):
-        train_preds = np.argmax(train_preds, axis=1)
-        train_acc = simple_accuracy(train_preds, train_label_ids)
-        train_preds = None
-        train_label_ids = None
-        results = evaluate(args, model, tokenizer, val_dataset)
+    checkpoint_writer = CheckpointWriter() if args.rank in [-1, 0] else None
+    eval_engine = evaluation_engine(args, tokenizer, val_dataset) if args.rank in [-1, 0] else None
+    evaluator = None
+    eval_train_acc = {}  # training accuracy of the snapshots that are being evaluated
+    if args.async_eval and args.rank in [-1, 0]:
+        eval_args = copy.copy(args)
+        eval_args.device = torch.device(args.eval_device) if args.eval_device else args.device
+        eval_args.n_gpu = 1 if eval_args.device.type == "cuda" else 0
+        if eval_args.device.type == "cpu" and eval_args.amp_dtype == "fp16":
+            eval_args.amp_dtype = None
+        eval_args.dataloader_num_workers = 0  # the evaluation process is a daemon, which cannot start workers
+        evaluator = AsyncEvaluator(
+            functools.partial(build_model, args, (model.module if hasattr(model, "module") else model).config),
+            functools.partial(
+                evaluate,
+                eval_args,
+                tokenizer=tokenizer,
+                val_dataset=val_dataset,
+                engine=evaluation_engine(eval_args, tokenizer, val_dataset),
+            ),
+            functools.partial(save_model, args, tokenizer),
+            eval_args.device,
+            best=resume_state["best_dev_acc"] if resume_state is not None else 0.0,
+        )
+
+    def record_results(results, step, train_acc, best_steps, best_dev_acc, is_best, model=None):
         logger.info(
             "dev acc: %s, loss: %s, global steps: %s",
             str(results["eval_acc"]),
             str(results["eval_loss"]),
-            str(global_step),
+            str(step),
         )
-        tb_writer.add_scalar("training/acc", train_acc, global_step)
+        tb_writer.add_scalar("training/acc", train_acc, step)
         for key, value in results.items():
-            tb_writer.add_scalar("eval_{}".format(key), value, global_step)
-        if results["eval_acc"] > best_dev_acc:
+            tb_writer.add_scalar("eval_{}".format(key), value, step)
+        if is_best:
             best_dev_acc = results["eval_acc"]
-            best_steps = global_step
+            best_steps = step
             logger.info("!!!!!!!!!!!!!!!!!!!! achieve BEST dev acc: %s at global step: %s",
                         str(best_dev_acc),
                         str(best_steps)
                         )
 
-            # save best dev acc model
-            output_dir = args.output_dir
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-            model_to_save = (
-                model.module if hasattr(model, "module") else model
-            )  # Take care of distributed/parallel training
-            logger.info("Current local rank %s", args.local_rank)
-            model_to_save.save_pretrained(output_dir)
-            tokenizer.save_vocabulary(output_dir)
-            tokenizer.save_pretrained(output_dir)
-            torch.save(args, os.path.join(output_dir, "training_args.bin"))
-            logger.info("Saving model checkpoint to %s", output_dir)
-            txt_dir = os.path.join(output_dir, 'best_dev_results.txt')
-            with open(txt_dir, 'w') as f:
-                rs = 'global_steps: {}; dev_acc: {}'.format(global_step, best_dev_acc)
-                f.write(rs)
-                tb_writer.add_text('best_results', rs, global_step)
+            # save best dev acc model, the background evaluator saves the snapshot it evaluated itself
+            if model is not None:
+                save_model(args, tokenizer, model, step, results, checkpoint_writer)
+            rs = 'global_steps: {}; dev_acc: {}'.format(step, best_dev_acc)
+            tb_writer.add_text('best_results', rs, step)
 
         logger.info("current BEST dev acc: %s at global step: %s",
                     str(best_dev_acc),
                     str(best_steps)
                     )
 
-        return train_preds, train_label_ids, train_acc, best_steps, best_dev_acc
+        return best_steps, best_dev_acc
+
+    def evaluate_model(train_acc, tb_writer, args, model, tokenizer, best_steps, best_dev_acc, val_dataset):
+        if evaluator is not None:
+            evaluator.submit(global_step, model.module if hasattr(model, "module") else model)
+            eval_train_acc[global_step] = train_acc
+            return best_steps, best_dev_acc
+        # only the first process evaluates, so it bypasses DistributedDataParallel, whose forward pass would
+        # broadcast the buffers to processes that are not taking part
+        results = evaluate(
+            args, model.module if args.local_rank != -1 else model, tokenizer, val_dataset, engine=eval_engine
+        )
+        return record_results(
+            results, global_step, train_acc, best_steps, best_dev_acc, results["eval_acc"] > best_dev_acc, model
+        )
 
     global_step = 0
     tr_loss, logging_loss = 0.0, 0.0
     best_dev_acc = 0.0
     best_steps = 0
-    train_preds = None
-    train_label_ids = None
+    start_epoch = 0
+    # predictions of the current logging window, combined over all processes when they are logged
+    train_metrics = PredictionAccumulator(
+        args.logging_steps * args.gradient_accumulation_steps * args.train_batch_size,
+        args.device,
+        distributed=args.local_rank != -1,
+    )
+    if resume_state is not None:
+        global_step = resume_state["global_step"]
+        tr_loss, logging_loss = resume_state["tr_loss"], resume_state["logging_loss"]
+        best_dev_acc, best_steps = resume_state["best_dev_acc"], resume_state["best_steps"]
+        start_epoch = resume_state["epoch"]
+        train_metrics.load_state_dict(resume_state["train_metrics"][rank])
     model.zero_grad()
     set_seed(args)  # Added here for reproductibility
-    for epoch_index in range(int(args.num_train_epochs)):
+    profiler = step_profiler(summaries_dir(args), args.device, args.profile_start_step, args.profile_steps, global_step)
+    profiler.start()
+    for epoch_index in range(start_epoch, int(args.num_train_epochs)):
         logger.info('')
         logger.info('%s Epoch: %d %s', '*'*50, epoch_index, '*'*50)
-        for step, batch in enumerate(train_dataloader):
+        if isinstance(train_dataset, IterableDataset):
+            train_dataset.set_epoch(epoch_index)
+        elif args.group_by_length:
+            train_sampler.set_epoch(epoch_index)
+        # the data loader draws its shuffling seeds from these states when it starts the epoch
+        if resume_state is not None:
+            set_rng_state(resume_state["epoch_rng_state"][rank])
+        epoch_rng_state = get_rng_state()
+        epoch_iterator = iter(train_dataloader)
+        start_step = 0
+        if resume_state is not None:
+            # replay the batches of the interrupted epoch that were already trained on
+            start_step = resume_state["step"]
+            for _ in itertools.islice(epoch_iterator, start_step):
+                pass
+            set_rng_state(resume_state["rng_state"][rank])
+            resume_state = None
+        batches = step_stats.timed_batches(prefetch_to_device(epoch_iterator, args.device, unused_fields(args)))
+        for step, batch in enumerate(batches, start_step):
             model.train()
-            batch = tuple(t.to(args.device) for t in batch)
-
-            inputs = {
-                "input_ids": batch[0],
-                "attention_mask": batch[1],
-                "token_type_ids": batch[2]
-                if args.model_type in ["bert", "xlnet", "albert"]
-                else None,  # XLM, Roberta don't use segment_ids
-                "labels": batch[3],
-            }
-            outputs = model(**inputs)
-            loss = outputs[0]  # model outputs are always tuple in transformers (see doc)
-            logits_1 = outputs[1]
-
-            # inputs_2 = {
-            #     "input_ids": batch[4],
-            #     "attention_mask": batch[5],
-            #     "token_type_ids": batch[6]
-            #     if args.model_type in ["bert", "xlnet", "albert"]
-            #     else None,
-            #     "labels": batch[7],
-            # }
-            # outputs_2 = model(**inputs_2)
-            # loss_2 = outputs_2[0]
-            # loss = loss + loss_2
-
-            ################# work only gpu = 1 ######################
-            if train_preds is None:
-                train_preds = logits_1.detach().cpu().numpy()
-                train_label_ids = inputs['labels'].detach().cpu().numpy()
-            else:
-                train_preds = np.append(train_preds, logits_1.detach().cpu().numpy(), axis=0)
-                train_label_ids = np.append(train_label_ids, inputs['labels'].detach().cpu().numpy(), axis=0)
-            ###########################################################
-
-            if args.n_gpu > 1:
-                loss = loss.mean()  # mean() to average on multi-gpu parallel training
-            if args.gradient_accumulation_steps > 1:
-                loss = loss / args.gradient_accumulation_steps
-
-            if args.fp16:
-                with amp.scale_loss(loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
-                    # scaled_loss.backward(retain_graph=True)
-                if not args.no_clip_grad_norm:
-                    torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
-            else:
-                loss.backward()
-                # loss.backward(retain_graph=True)
-                if not args.no_clip_grad_norm:
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
 
-            tr_loss += loss.item()
-
-
-
-            inputs_2 = {
-                "input_ids": batch[4],
-                "attention_mask": batch[5],
-                "token_type_ids": batch[6]
-                if args.model_type in ["bert", "xlnet", "albert"]
-                else None,
-                "labels": batch[7],
-            }
-            outputs_2 = model(**inputs_2)
-            loss_2 = outputs_2[0]
-
-            if args.n_gpu > 1:
-                loss_2 = loss_2.mean()  # mean() to average on multi-gpu parallel training
-            if args.gradient_accumulation_steps > 1:
-                loss_2 = loss_2 / args.gradient_accumulation_steps
-
-            if args.fp16:
-                with amp.scale_loss(loss_2, optimizer) as scaled_loss:
-                    scaled_loss.backward()
-                if not args.no_clip_grad_norm:
-                    torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
-            else:
-                loss_2.backward()
-                if not args.no_clip_grad_norm:
+            sync_gradients = (step + 1) % args.gradient_accumulation_steps == 0
+            with gradient_sync(model, sync_gradients):
+                if args.fused_contrastive_forward:
+                    # both groups of choices go through the encoder as one batch of 4 + 2 choices, with one backward
+                    # pass and one gradient clipping below
+                    padding_side = tokenizer.padding_side
+                    inputs = {
+                        "input_ids": concat_choice_groups([batch[0], batch[4]], tokenizer.pad_token_id, padding_side),
+                        "attention_mask": concat_choice_groups([batch[1], batch[5]], 0, padding_side),
+                        "token_type_ids": concat_choice_groups(
+                            [batch[2], batch[6]], 4 if args.model_type in ["xlnet"] else 0, padding_side
+                        )
+                        if args.model_type in ["bert", "xlnet", "albert"]
+                        else None,  # XLM, Roberta don't use segment_ids
+                    }
+                    step_stats.add_batch(inputs["attention_mask"])
+                    with step_stats.phase("forward"), autocast(args.device, args.amp_dtype):
+                        outputs = model(**inputs)
+                        loss, (logits_1, _) = grouped_multiple_choice_loss(
+                            outputs[0], [batch[3], batch[7]], [batch[0].size(1), batch[4].size(1)]
+                        )
+                    inputs["labels"] = batch[3]
+                else:
+                    inputs = {
+                        "input_ids": batch[0],
+                        "attention_mask": batch[1],
+                        "token_type_ids": batch[2]
+                        if args.model_type in ["bert", "xlnet", "albert"]
+                        else None,  # XLM, Roberta don't use segment_ids
+                        "labels": batch[3],
+                    }
+                    step_stats.add_batch(inputs["attention_mask"])
+                    with step_stats.phase("forward"), autocast(args.device, args.amp_dtype):
+                        outputs = model(**inputs)
+                    loss = outputs[0]  # model outputs are always tuple in transformers (see doc)
+                    logits_1 = outputs[1]
+
+                # inputs_2 = {
+                #     "input_ids": batch[4],
+                #     "attention_mask": batch[5],
+                #     "token_type_ids": batch[6]
+                #     if args.model_type in ["bert", "xlnet", "albert"]
+                #     else None,
+                #     "labels": batch[7],
+                # }
+                # outputs_2 = model(**inputs_2)
+                # loss_2 = outputs_2[0]
+                # loss = loss + loss_2
+
+                train_metrics.add(logits_1, inputs["labels"])
+
+                if args.n_gpu > 1:
+                    loss = loss.mean()  # mean() to average on multi-gpu parallel training
+                if args.gradient_accumulation_steps > 1:
+                    loss = loss / args.gradient_accumulation_steps
+
+                with step_stats.phase("backward"):
+                    scaler.scale(loss).backward()
+                # with distributed training the gradients of a micro-step are local until the last one is reduced
+                if not args.no_clip_grad_norm and not scaler.is_enabled() and (sync_gradients or args.local_rank == -1):
                     torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
 
-            tr_loss += loss_2.item()
-            
+                tr_loss += loss.item()
+
+
+
+                if not args.fused_contrastive_forward:
+                    inputs_2 = {
+                        "input_ids": batch[4],
+                        "attention_mask": batch[5],
+                        "token_type_ids": batch[6]
+                        if args.model_type in ["bert", "xlnet", "albert"]
+                        else None,
+                        "labels": batch[7],
+                    }
+                    step_stats.add_batch(inputs_2["attention_mask"], count_samples=False)
+                    with step_stats.phase("forward"), autocast(args.device, args.amp_dtype):
+                        outputs_2 = model(**inputs_2)
+                    loss_2 = outputs_2[0]
+
+                    if args.n_gpu > 1:
+                        loss_2 = loss_2.mean()  # mean() to average on multi-gpu parallel training
+                    if args.gradient_accumulation_steps > 1:
+                        loss_2 = loss_2 / args.gradient_accumulation_steps
+
+                    with step_stats.phase("backward"):
+                        scaler.scale(loss_2).backward()
+                    if not args.no_clip_grad_norm and not scaler.is_enabled():
+                        torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
 
+                    tr_loss += loss_2.item()
 
             if step % 20 == 0:
                 logger.info("********** Iteration %d: current loss: %s", step, str(round(loss.item(), 4)),)
 
-            if (step + 1) % args.gradient_accumulation_steps == 0:
-                optimizer.step()
-                scheduler.step()  # Update learning rate schedule
-                model.zero_grad()
+            if sync_gradients:
+                with step_stats.phase("optimizer"):
+                    if not args.no_clip_grad_norm and scaler.is_enabled():
+                        # the gradients are scaled, so they are unscaled and clipped once per optimizer step
+                        scaler.unscale_(optimizer)
+                        torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+                    scaler.step(optimizer)
+                    scaler.update()
+                    scheduler.step()  # Update learning rate schedule
+                    model.zero_grad()
+                step_stats.step()
+                profiler.step()
                 # optimizer.zero_grad()
                 global_step += 1
-
-                if args.local_rank in [-1, 0] and args.logging_steps > 0 and global_step % args.logging_steps == 0:
-                    # if (args.local_rank == -1 and args.evaluate_during_training):  # Only evaluate when single GPU otherwise metrics may not average well
-                    if args.evaluate_during_training:  # Only evaluate when single GPU otherwise metrics may not average well
-                        train_preds, train_label_ids, train_acc, best_steps, best_dev_acc = evaluate_model(train_preds, train_label_ids, tb_writer, args, model, tokenizer, best_steps, best_dev_acc, val_dataset)
+                peak_memory = peak_memory_mb(args.device)
+                if args.rank in [-1, 0]:
+                    tb_writer.add_scalar("training/{}_mb".format(memory_name), peak_memory, global_step)
+
+                if args.logging_steps > 0 and global_step % args.logging_steps == 0:
+                    # every process takes part in gathering the predictions of the logging window
+                    train_preds, train_label_ids = train_metrics.gather()
+                    train_acc = simple_accuracy(np.argmax(train_preds, axis=1), train_label_ids)
+                    train_metrics.reset()
+                    if args.rank in [-1, 0] and args.evaluate_during_training:
+                        with step_stats.phase("evaluation"):
+                            best_steps, best_dev_acc = evaluate_model(train_acc, tb_writer, args, model, tokenizer, best_steps, best_dev_acc, val_dataset)
                         tb_writer.add_scalar("training/lr", scheduler.get_lr()[0], global_step)
                         tb_writer.add_scalar("training/loss", (tr_loss - logging_loss) / args.logging_steps, global_step)
                         logger.info(
-                            "Average loss: %s, average acc: %s at global step: %s",
+                            "Average loss: %s, average acc: %s, %s: %.1f MB at global step: %s",
                             str((tr_loss - logging_loss) / args.logging_steps),
                             str(train_acc),
+                            memory_name.replace("_", " "),
+                            peak_memory,
                             str(global_step),
                         )
                         logging_loss = tr_loss
+                    step_stats.log(global_step)
+
+                if evaluator is not None:
+                    for eval_step, results, is_best in evaluator.poll():
+                        best_steps, best_dev_acc = record_results(
+                            results, eval_step, eval_train_acc.pop(eval_step), best_steps, best_dev_acc, is_best
+                        )
 
-                # if args.local_rank in [-1, 0] and args.save_steps > 0 and global_step % args.save_steps == 0:
-                #     save_model(args, model, tokenizer)
+                if args.save_steps > 0 and global_step % args.save_steps == 0:
+                    # every process contributes its random states and training predictions
+                    rank_state = (epoch_rng_state, get_rng_state(), train_metrics.state_dict())
+                    rank_states = [rank_state]
+                    if args.local_rank != -1:
+                        rank_states = [None] * torch.distributed.get_world_size()
+                        torch.distributed.all_gather_object(rank_states, rank_state)
+                    if args.rank in [-1, 0]:
+                        if evaluator is not None:
+                            # the best dev acc of the state has to include the snapshots still being evaluated
+                            for eval_step, results, is_best in evaluator.poll(block=True):
+                                best_steps, best_dev_acc = record_results(
+                                    results, eval_step, eval_train_acc.pop(eval_step), best_steps, best_dev_acc, is_best
+                                )
+                        training_state = {
+                            "optimizer": optimizer.state_dict(),
+                            "scheduler": scheduler.state_dict(),
+                            "scaler": scaler.state_dict(),
+                            "amp_dtype": args.amp_dtype,
+                            "global_step": global_step,
+                            "epoch": epoch_index,
+                            "step": step + 1,
+                            "tr_loss": tr_loss,
+                            "logging_loss": logging_loss,
+                            "best_dev_acc": best_dev_acc,
+                            "best_steps": best_steps,
+                            "epoch_rng_state": [state[0] for state in rank_states],
+                            "rng_state": [state[1] for state in rank_states],
+                            "train_metrics": [state[2] for state in rank_states],
+                        }
+                        checkpoint_writer.save(
+                            training_state_dir(args), unwrap_model(model), tokenizer, args, training_state=training_state
+                        )
+                        logger.info("Saving training state to %s", training_state_dir(args))
             if args.max_steps > 0 and global_step > args.max_steps:
                 break
         if args.max_steps > 0 and global_step > args.max_steps:
             break
 
-    if args.local_rank in [-1, 0] and train_preds is not None:
-        train_preds, train_label_ids, train_acc, best_steps, best_dev_acc = evaluate_model(train_preds, train_label_ids, tb_writer, args, model, tokenizer, best_steps, best_dev_acc, val_dataset)
+    profiler.stop()
+
+    if train_metrics.count:
+        train_preds, train_label_ids = train_metrics.gather()
+        train_acc = simple_accuracy(np.argmax(train_preds, axis=1), train_label_ids)
+        if args.rank in [-1, 0]:
+            best_steps, best_dev_acc = evaluate_model(train_acc, tb_writer, args, model, tokenizer, best_steps, best_dev_acc, val_dataset)
+    if evaluator is not None:
+        for eval_step, results, is_best in evaluator.close():
+            best_steps, best_dev_acc = record_results(
+                results, eval_step, eval_train_acc.pop(eval_step), best_steps, best_dev_acc, is_best
+            )
+    if args.rank in [-1, 0]:
+        checkpoint_writer.close()
         tb_writer.close()
 
     return global_step, tr_loss / global_step, best_steps
 
 
-def evaluate(args, model, tokenizer, val_dataset=None, prefix="", test=False):
-    eval_task_names = (args.task_name,)
-    eval_outputs_dirs = (args.output_dir,)
-
-    results = {}
-    for eval_task, eval_output_dir in zip(eval_task_names, eval_outputs_dirs):
-        eval_dataset = val_dataset
-
-        if not os.path.exists(eval_output_dir) and args.local_rank in [-1, 0]:
-            os.makedirs(eval_output_dir)
-
-        args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
-        # Note that DistributedSampler samples randomly
-        eval_sampler = SequentialSampler(eval_dataset)
-        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
-
-        # multi-gpu evaluate
-        if args.n_gpu > 1:
-            model = torch.nn.DataParallel(model)
-
-        # Eval!
-        logger.info("************************* Running evaluation {} *************************".format(prefix))
-        logger.info("Num examples = %d", len(eval_dataset))
-        logger.info("Batch size = %d", args.eval_batch_size)
-        eval_loss = 0.0
-        nb_eval_steps = 0
-        preds = None
-        out_label_ids = None
-        model.eval()
-        for batch in eval_dataloader:
-            batch = tuple(t.to(args.device) for t in batch)
-
-            with torch.no_grad():
-                inputs = {
-                    "input_ids": batch[0],
-                    "attention_mask": batch[1],
-                    "token_type_ids": batch[2]
-                    if args.model_type in ["bert", "xlnet", "albert"]
-                    else None,  # XLM don't use segment_ids
-                    "labels": batch[3],
-                }
-                outputs = model(**inputs)
-                tmp_eval_loss, logits = outputs[:2]
-
-                eval_loss += tmp_eval_loss.mean().item()
-            nb_eval_steps += 1
-            if preds is None:
-                preds = logits.detach().cpu().numpy()
-                out_label_ids = inputs["labels"].detach().cpu().numpy()
-
-            else:
-                preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
-
-        eval_loss = eval_loss / nb_eval_steps
-        preds = np.argmax(preds, axis=1)
-        acc = simple_accuracy(preds, out_label_ids)
-
-        result = {"eval_acc": acc, "eval_loss": eval_loss}
-        results.update(result)
-
-        logger.info("***** Eval results {} *****".format(str(prefix) + "----is test:" + str(test)))
-        if test:
-            for key in sorted(result.keys()):
-                logger.info("%s = %s", key, str(result[key]))
+def evaluation_engine(args, tokenizer, dataset):
+    """ Builds the engine that evaluates models on ``dataset``, set up once and reused by every evaluation """
+    loader_options = dataloader_options(
+        args.dataloader_num_workers,
+        args.device.type == "cuda" and not args.no_pin_memory,
+        args.dataloader_prefetch_factor,
+        persistent_workers=True,
+    )
+    return EvaluationEngine(
+        dataset,
+        FEATURE_FIELDS,
+        args.device,
+        batch_size=args.per_gpu_eval_batch_size,
+        padding_side=tokenizer.padding_side,
+        amp_dtype=args.amp_dtype,
+        skip=unused_fields(args),
+        data_parallel=args.n_gpu > 1,
+        loader_options=loader_options,
+    )
+
+
+def evaluate(args, model, tokenizer, val_dataset=None, prefix="", test=False, engine=None):
+    if engine is None:
+        engine = evaluation_engine(args, tokenizer, val_dataset)
+
+    # Eval!
+    logger.info("************************* Running evaluation {} *************************".format(prefix))
+    logger.info("Num examples = %d", len(engine))
+    # the evaluation is only profiled when it is not part of training
+    profiler = step_profiler(
+        summaries_dir(args), args.device, args.profile_start_step, args.profile_steps if not args.do_train else 0
+    )
+    profiler.start()
+    eval_loss, preds, out_label_ids = engine.run(model, profiler)
+    profiler.stop()
+    logger.info("Batch size = %d", engine.batch_size * engine.num_devices)
+
+    preds = np.argmax(preds, axis=1)
+    acc = simple_accuracy(preds, out_label_ids)
+    results = {"eval_acc": acc, "eval_loss": eval_loss}
+
+    logger.info("***** Eval results {} *****".format(str(prefix) + "----is test:" + str(test)))
+    if test:
+        for key in sorted(results.keys()):
+            logger.info("%s = %s", key, str(results[key]))
 
     if test:
         return results, preds
@@ -632,6 +1102,7 @@ def main():
         and os.listdir(args.output_dir)
         and args.do_train
         and not args.overwrite_output_dir
+        and not args.resume_from
     ):
         raise ValueError(
             "Output directory ({}) already exists and is not empty. Use --overwrite_output_dir to overcome.".format(
@@ -639,20 +1110,58 @@ def main():
             )
         )
 
+    if args.resume_from:
+        # the best model so far is in the output directory of the interrupted run, the test loads it from there
+        resumed_output_dir = load_training_args(args.resume_from).output_dir
+        if os.path.abspath(resumed_output_dir) != os.path.abspath(args.output_dir):
+            raise ValueError(
+                "The training state {} continues the run with --output_dir {}, got {}".format(
+                    args.resume_from, resumed_output_dir, args.output_dir
+                )
+            )
+
     # Setup CUDA, GPU & distributed training
     print(args.local_rank)
-    if args.local_rank == -1 or args.no_cuda:
+    if args.local_rank == -1 and "LOCAL_RANK" in os.environ:  # started by torchrun
+        args.local_rank = int(os.environ["LOCAL_RANK"])
+    # args.local_rank stays the rank on this machine, which decides who writes the caches of the machine, while
+    # args.rank is the global rank, whose first process logs, evaluates and saves the checkpoints
+    if args.local_rank == -1:
         device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
         args.n_gpu = torch.cuda.device_count()
+        args.rank = -1
         print("num gpu", args.n_gpu)
+    elif args.no_cuda or not torch.cuda.is_available():
+        # CPU data-parallel training, with one process per socket or NUMA node of every machine
+        torch.distributed.init_process_group(backend="gloo")
+        cpus = bind_cpu_rank(
+            args.local_rank,
+            int(os.environ.get("LOCAL_WORLD_SIZE", torch.distributed.get_world_size())),
+            args.cpu_binding,
+            args.cpu_threads_per_rank,
+        )
+        logger.warning(
+            'rank: %s, cpus: %s, threads: %s', torch.distributed.get_rank(), cpus, torch.get_num_threads()
+        )
+        args.rank = torch.distributed.get_rank()
+        device = torch.device("cpu")
+        args.n_gpu = 0
     else:  # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
         torch.distributed.init_process_group(backend="nccl")
         logger.warning('local_rank: %s, gpu_num: %s', torch.distributed.get_rank(), torch.cuda.device_count(),)
-        args.local_rank = torch.distributed.get_rank()
+        args.rank = torch.distributed.get_rank()
         torch.cuda.set_device(args.local_rank)
         device = torch.device("cuda", args.local_rank)
         args.n_gpu = 1
     args.device = device
+    if args.fp16 and args.bf16:
+        raise ValueError("Only one of --fp16 and --bf16 can be set")
+    if args.fp16 and device.type == "cpu":
+        raise ValueError("fp16 mixed precision needs a GPU, use --bf16 on CPU")
+    args.amp_dtype = "fp16" if args.fp16 else "bf16" if args.bf16 else None
+    if args.local_rank != -1 and not args.fused_contrastive_forward:
+        # one forward and backward pass per micro-step, so the gradients are reduced once per optimizer step
+        raise ValueError("Distributed training scores the contrastive choices in one pass, set --fused_contrastive_forward")
 
     # set random seed
     set_seed(args)
@@ -661,15 +1170,16 @@ def main():
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
         datefmt="%m/%d/%Y %H:%M:%S",
-        level=logging.INFO if args.local_rank in [-1, 0] else logging.WARN,
+        level=logging.INFO if args.rank in [-1, 0] else logging.WARN,
     )
     logger.warning(
-        "Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, 16-bits training: %s",
+        "Process rank: %s, local rank: %s, device: %s, n_gpu: %s, distributed training: %s, mixed precision: %s",
+        args.rank,
         args.local_rank,
         device,
         args.n_gpu,
         bool(args.local_rank != -1),
-        args.fp16,
+        args.amp_dtype,
     )
 
     # Prepare GLUE task
@@ -686,6 +1196,8 @@ def main():
 
     args.model_type = args.model_type.lower()
     config_class, model_class, tokenizer_class = MODEL_CLASSES[args.model_type]
+    if args.fast_tokenizer:
+        tokenizer_class = FAST_TOKENIZER_CLASSES[args.model_type]
 
     config = config_class.from_pretrained(
         args.config_name if args.config_name else args.model_name_or_path,
@@ -711,6 +1223,12 @@ def main():
         special_tokens_dict = {'additional_special_tokens': ['<ext>']}
         num_added_toks = tokenizer.add_special_tokens(special_tokens_dict)
         model.resize_token_embeddings(len(tokenizer))
+    if args.resume_from:
+        model.load_state_dict(torch.load(os.path.join(args.resume_from, WEIGHTS_NAME), map_location="cpu"))
+    if args.gradient_checkpointing:
+        enable_gradient_checkpointing(model, every=args.gradient_checkpointing_every)
+    if args.pack_sequences:
+        model = PackedMultipleChoiceModel(model)
 
     if args.local_rank == 0:
         torch.distributed.barrier()  # Make sure only the first process in distributed training will download model & vocab
@@ -731,7 +1249,7 @@ def main():
 
     # Test
 
-    if args.do_test and args.local_rank in [-1, 0]:
+    if args.do_test and args.rank in [-1, 0]:
         if not args.do_train:
             checkpoint_dir = args.model_name_or_path
         if args.evaluate_during_training:
@@ -742,8 +1260,12 @@ def main():
             logger.info("best steps of eval acc is the following checkpoints: %s", best_steps)
 
         model = model_class.from_pretrained(checkpoint_dir)
+        if args.pack_sequences:
+            model = PackedMultipleChoiceModel(model)
         model.to(args.device)
         result, preds = evaluate(args, model, tokenizer, test_dataset, test=True)
+        if not os.path.exists(args.output_dir):
+            os.makedirs(args.output_dir)
         np.save(os.path.join(args.output_dir, "test_preds.npy" if args.output_dir is not None else "test_preds.npy"), preds)
 
     # # Evaluation
@@ -0,0 +1,172 @@
+### Batch prediction with a trained checkpoint on any ReClor-format question file, without the training scripts
+
+import argparse
+import logging
+import os
+
+import numpy as np
+import torch
+
+from main_large import FAST_TOKENIZER_CLASSES, FEATURE_DTYPES, FEATURE_FIELDS, MODEL_CLASSES, unused_fields
+from utils_multiple_choice import ReclorProcessor, convert_examples_to_features
+from utils_packing import PackedMultipleChoiceModel
+from utils_training import EvaluationEngine, FeatureDataset, dataloader_options, load_training_args
+
+logger = logging.getLogger(__name__)
+
+
+def init_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Writes the per-choice logits and probabilities of a trained checkpoint on ReClor-format questions"
+    )
+    parser.add_argument(
+        "--model_dir",
+        default=None,
+        type=str,
+        required=True,
+        help="Checkpoint directory saved by main_large.py or main_large_contrastive.py",
+    )
+    parser.add_argument(
+        "--input_file",
+        default=None,
+        type=str,
+        required=True,
+        help="JSON file of questions in the ReClor format, the labels are not needed",
+    )
+    parser.add_argument(
+        "--extended_context_file",
+        default=None,
+        type=str,
+        help="The .npy array of the extended contexts of the questions, e.g. test_extended_context_cp_v1.npy. "
+        "Needed by checkpoints trained with --whether_extend_context",
+    )
+    parser.add_argument(
+        "--output_file",
+        default=None,
+        type=str,
+        required=True,
+        help="The .npz file the question ids, logits, probabilities and predictions are written to",
+    )
+    parser.add_argument(
+        "--max_seq_length",
+        default=0,
+        type=int,
+        help="The maximum total input sequence length after tokenization, 0 for the length of the training",
+    )
+    parser.add_argument(
+        "--per_gpu_batch_size",
+        default=0,
+        type=int,
+        help="Batch size per GPU/CPU, 0 to size it automatically to the memory of the GPU, or to 8192 tokens per "
+        "batch on CPU",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        default=1000,
+        type=int,
+        help="Number of questions that are converted to features and scored at a time",
+    )
+    parser.add_argument(
+        "--fast_tokenizer", action="store_true", help="Tokenize in batches with the fast (Rust) tokenizer"
+    )
+    parser.add_argument(
+        "--tokenize_batch_size", default=1000, type=int, help="Number of texts per call of the fast tokenizer"
+    )
+    parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
+    parser.add_argument("--fp16", action="store_true", help="Run the model in fp16 mixed precision (GPU only)")
+    parser.add_argument("--bf16", action="store_true", help="Run the model in bf16 mixed precision")
+    return parser.parse_args(argv)
+
+
+def softmax(logits):
+    exp_logits = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return exp_logits / exp_logits.sum(axis=-1, keepdims=True)
+
+
+def main():
+    args = init_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    if args.fp16 and args.bf16:
+        raise ValueError("Only one of --fp16 and --bf16 can be set")
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    n_gpu = torch.cuda.device_count() if device.type == "cuda" else 0
+    if args.fp16 and device.type == "cpu":
+        raise ValueError("fp16 mixed precision needs a GPU, use --bf16 on CPU")
+    amp_dtype = "fp16" if args.fp16 else "bf16" if args.bf16 else None
+
+    # the features are built the way the checkpoint was trained
+    train_args = load_training_args(args.model_dir)
+    if train_args.whether_extend_context and args.extended_context_file is None:
+        raise ValueError("{} was trained with extended contexts, set --extended_context_file".format(args.model_dir))
+    max_seq_length = args.max_seq_length or train_args.max_seq_length
+    model_type = train_args.model_type
+    config_class, model_class, tokenizer_class = MODEL_CLASSES[model_type]
+    if args.fast_tokenizer:
+        tokenizer_class = FAST_TOKENIZER_CLASSES[model_type]
+    tokenizer = tokenizer_class.from_pretrained(args.model_dir, do_lower_case=train_args.do_lower_case)
+    model = model_class.from_pretrained(args.model_dir)
+    if getattr(train_args, "pack_sequences", False):
+        model = PackedMultipleChoiceModel(model)
+    model.to(device)
+    logger.info("Loaded %s model from %s on %s", model_type, args.model_dir, device)
+
+    processor = ReclorProcessor()
+    label_list = processor.get_labels()
+    examples = processor.get_examples_from_file(args.input_file, args.extended_context_file)
+    logits = np.zeros((len(examples), len(label_list)), dtype=np.float32)
+
+    batch_size = args.per_gpu_batch_size
+    loader_options = dataloader_options(pin_memory=device.type == "cuda")
+    for start in range(0, len(examples), args.chunk_size):
+        chunk = examples[start:start + args.chunk_size]
+        arrays = convert_examples_to_features(
+            chunk,
+            label_list,
+            max_seq_length,
+            tokenizer,
+            ques_type_before=train_args.ques_type_before,
+            pad_on_left=bool(model_type in ["xlnet"]),  # pad on the left for xlnet
+            pad_token_segment_id=4 if model_type in ["xlnet"] else 0,
+            whether_extend_context=train_args.whether_extend_context,
+            batch_size=args.tokenize_batch_size if args.fast_tokenizer else 0,
+            dtypes=FEATURE_DTYPES,
+        )
+        dataset = FeatureDataset(
+            *[torch.from_numpy(arrays[field]) for field in FEATURE_FIELDS], lengths=arrays["lengths"]
+        )
+        engine = EvaluationEngine(
+            dataset,
+            FEATURE_FIELDS,
+            device,
+            batch_size=batch_size,
+            padding_side=tokenizer.padding_side,
+            amp_dtype=amp_dtype,
+            skip=unused_fields(train_args),
+            data_parallel=n_gpu > 1,
+            loader_options=loader_options,
+        )
+        # the test examples have no labels, so the loss is meaningless
+        _, logits[start:start + len(chunk)], _ = engine.run(model)
+        batch_size = engine.batch_size  # sized on the first chunk only
+        logger.info("Scored %d of %d questions", start + len(chunk), len(examples))
+
+    output_dir = os.path.dirname(args.output_file)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    np.savez_compressed(
+        args.output_file,
+        ids=np.array([example.example_id for example in examples]),
+        logits=logits,
+        probabilities=softmax(logits),
+        predictions=logits.argmax(axis=-1),
+    )
+    logger.info("Saving the predictions of %d questions to %s", len(examples), args.output_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,14 +12,12 @@ python -m torch.distributed.launch --nproc_per_node=4 main_large.py \
     --do_lower_case \
     --data_dir $RECLOR_DIR \
     --max_seq_length 256 \
-    --per_gpu_eval_batch_size 2  \
     --per_gpu_train_batch_size 2  \
     --gradient_accumulation_steps 1 \
     --learning_rate 1e-5 \
     --num_train_epochs 10.0 \
     --output_dir ../Checkpoints/reclor/albert_base \
     --logging_steps 200 \
-    --save_steps 200 \
     --adam_betas "(0.9, 0.98)" \
     --adam_epsilon 1e-6 \
     --no_clip_grad_norm \
@@ -27,7 +25,6 @@ python -m torch.distributed.launch --nproc_per_node=4 main_large.py \
     --weight_decay 0.01 \
     --overwrite_output_dir \
     --ques_type_before 1 \
-    --overwrite_cache \
     --extended_context_version 5 \
     --negative_context_version 19 \
     --negative_entend_context_version 195 \
@@ -61,7 +58,6 @@ python -m torch.distributed.launch --nproc_per_node=4 main_large.py \
 #    --weight_decay 0.01 \
 #    --overwrite_output_dir \
 #    --ques_type_before 1 \
-#    --overwrite_cache \
 #    --extended_context_version 5 \
 #    --negative_context_version 19 \
 #    --negative_entend_context_version 195 \
@@ -13,14 +13,13 @@ python -m torch.distributed.launch --nproc_per_node=4 main_large_contrastive.py
     --do_lower_case \
     --data_dir $RECLOR_DIR \
     --max_seq_length 256 \
-    --per_gpu_eval_batch_size 2  \
     --per_gpu_train_batch_size 2  \
     --gradient_accumulation_steps 1 \
+    --fused_contrastive_forward \
     --learning_rate 1e-5 \
     --num_train_epochs 10.0 \
     --output_dir ../Checkpoints/reclor/roberta_augmentation \
     --logging_steps 200 \
-    --save_steps 200 \
     --adam_betas "(0.9, 0.98)" \
     --adam_epsilon 1e-6 \
     --no_clip_grad_norm \
@@ -28,7 +27,6 @@ python -m torch.distributed.launch --nproc_per_node=4 main_large_contrastive.py
     --weight_decay 0.01 \
     --overwrite_output_dir \
     --ques_type_before 1 \
-    --overwrite_cache \
     --extended_context_version 5 \
     --negative_context_version 19 \
     --negative_entend_context_version 195 \
@@ -0,0 +1,58 @@
+import argparse
+import os
+
+import numpy as np
+import pytest
+from torch.utils.data import DataLoader
+from transformers import BertConfig, BertTokenizer
+
+from utils_multiple_choice import get_feature_shards, save_feature_shards
+from utils_training import StreamingFeatureDataset, write_checkpoint
+
+
+def make_tokenizer(tmp_path):
+    vocab_file = tmp_path / "vocab.txt"
+    vocab_file.write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "a", "b"]))
+    return BertTokenizer(str(vocab_file))
+
+
+def test_write_checkpoint_replaces_empty_output_dir(tmp_path):
+    tokenizer = make_tokenizer(tmp_path)
+    config = BertConfig(vocab_size=7, hidden_size=8, num_hidden_layers=1, num_attention_heads=1, intermediate_size=8)
+    output_dir = tmp_path / "out" / "best"
+    output_dir.mkdir(parents=True)
+
+    write_checkpoint(str(output_dir), config, {}, tokenizer, argparse.Namespace(), {"best_dev_results.txt": "1"})
+
+    assert os.path.islink(str(output_dir))
+    checkpoint_dirs = sorted(path.name for path in (tmp_path / "out").iterdir() if path.name != "best")
+    assert checkpoint_dirs == [os.readlink(str(output_dir))]
+    assert (output_dir / "best_dev_results.txt").read_text() == "1"
+    assert BertConfig.from_pretrained(str(output_dir)).hidden_size == 8
+
+    write_checkpoint(str(output_dir), config, {}, tokenizer, argparse.Namespace(), {"best_dev_results.txt": "2"})
+
+    assert (output_dir / "best_dev_results.txt").read_text() == "2"
+    # the previous checkpoint is kept for readers that resolved the link before the switch
+    assert len([path for path in (tmp_path / "out").iterdir() if path.name != "best"]) == 2
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_streaming_loader_length_matches_batches(tmp_path, num_workers):
+    # 21 rows split between 2 processes and 2 workers leave partial batches
+    cache_dir = str(tmp_path / "cache")
+    save_feature_shards(cache_dir, ({"input_ids": np.arange(size * 4).reshape(size, 4)} for size in (7, 5, 9)))
+    for rank in range(2):
+        dataset = StreamingFeatureDataset(
+            get_feature_shards(cache_dir),
+            ("input_ids",),
+            shuffle_buffer_size=4,
+            num_replicas=2,
+            rank=rank,
+            chunk_size=3,
+            batch_size=4,
+        )
+        loader = DataLoader(dataset, batch_size=4, num_workers=num_workers)
+        batches = list(loader)
+        assert len(batches) == len(loader)
+        assert sum(len(batch[0]) for batch in batches) == len(dataset)
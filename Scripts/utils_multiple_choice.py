@@ -1,9 +1,15 @@
 import csv
+import functools
 import glob
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
-from typing import List
+import shutil
+import socket
+import tempfile
+from typing import Dict, List
 import numpy as np
 
 import tqdm
@@ -35,16 +41,6 @@ class InputExample(object):
         self.extend_context = extend_context
 
 
-class InputFeatures(object):
-    def __init__(self, example_id, choices_features, label):
-        self.example_id = example_id
-        self.choices_features = [
-            {"input_ids": input_ids, "input_mask": input_mask, "segment_ids": segment_ids}
-            for input_ids, input_mask, segment_ids in choices_features
-        ]
-        self.label = label
-
-
 class DataProcessor(object):
     """Base class for data converters for multiple choice data sets."""
 
@@ -64,6 +60,10 @@ class DataProcessor(object):
         """Gets the list of labels for this data set."""
         raise NotImplementedError()
 
+    def get_data_files(self, data_dir, set_type):
+        """Gets the paths of the files the examples of ``set_type`` ("train", "dev" or "test") are read from."""
+        raise NotImplementedError()
+
 
 class RaceProcessor(DataProcessor):
     """Processor for the race-data data set."""
@@ -99,6 +99,13 @@ class RaceProcessor(DataProcessor):
         """See base class."""
         return ["0", "1", "2", "3"]
 
+    def get_data_files(self, data_dir, set_type):
+        """See base class."""
+        return sorted(
+            glob.glob(os.path.join(data_dir, set_type, "high") + "/*txt")
+            + glob.glob(os.path.join(data_dir, set_type, "middle") + "/*txt")
+        )
+
     def _read_txt(self, input_dir):
         lines = []
         files = glob.glob(input_dir + "/*txt")
@@ -156,10 +163,38 @@ class ReclorProcessor(DataProcessor):
         extend_context = np.load(os.path.join(data_dir, "test_extended_context_cp_v"+ str(version) +".npy"), allow_pickle=True)
         return self._create_examples(self._read_json(os.path.join(data_dir, "test.json")), "test", ques_types, extend_context)
 
+    def get_examples_from_file(self, input_file, extended_context_file=None):
+        """
+        Gets the examples of any JSON file in the ReClor format as test examples, with the extended contexts of the
+        ``extended_context_file`` array, or empty ones without it.
+        """
+        logger.info("LOOKING AT {}".format(input_file))
+        lines = self._read_json(input_file)
+        if extended_context_file is not None:
+            extend_context = np.load(extended_context_file, allow_pickle=True)
+            if len(extend_context) != len(lines):
+                raise ValueError(
+                    "{} has extended contexts for {} questions, {} has {} questions".format(
+                        extended_context_file, len(extend_context), input_file, len(lines)
+                    )
+                )
+        else:
+            extend_context = [["", "", "", ""]] * len(lines)
+        return self._create_examples(lines, "test", [""] * len(lines), extend_context)
+
     def get_labels(self):
         """See base class."""
         return [0, 1, 2, 3]
 
+    def get_data_files(self, data_dir, set_type, version=1):
+        """See base class."""
+        prefix = {"train": "train", "dev": "val", "test": "test"}[set_type]
+        return [
+            os.path.join(data_dir, prefix + ".json"),
+            os.path.join(data_dir, prefix + "_ques_types.npy"),
+            os.path.join(data_dir, prefix + "_extended_context_cp_v" + str(version) + ".npy"),
+        ]
+
     def _read_json(self, input_file):
         with open(input_file, "r") as f:
             lines = json.load(f)
@@ -189,6 +224,207 @@ class ReclorProcessor(DataProcessor):
         return examples
 
 
+def build_text_b(question, ending, ques_type_before=1):
+    """Builds the second sequence (question + option) of a choice."""
+    if question.find("_") != -1:
+        # this is for cloze question
+        if ques_type_before:
+            # text_b = example.ques_types + " " + example.question.replace("_", ending)
+            text_b = question.replace("_", ending)
+        else:
+            # text_b = example.question.replace("_", ending) + " " + example.ques_types
+            text_b = question.replace("_", ending)
+    else:
+        if ques_type_before:
+            # text_b = example.ques_types + " " + example.question + " " + ending
+            text_b = question + " " + ending
+        else:
+            # text_b = example.question + " " + example.ques_types + " " + ending
+            text_b = question + " " + ending
+    return text_b
+
+
+def tokenize_texts(texts, tokenizer, batch_size=0):
+    """
+    Tokenizes every text into a list of token ids without special tokens. If ``batch_size`` > 0, the texts are
+    tokenized with a fast tokenizer, ``batch_size`` texts per call.
+    """
+    if batch_size <= 0:
+        return [
+            tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text)) for text in tqdm.tqdm(texts, desc="tokenize texts")
+        ]
+
+    if not getattr(tokenizer, "is_fast", False):
+        raise ValueError(
+            "Batched tokenization needs a fast tokenizer, got {}".format(type(tokenizer).__name__)
+        )
+    text_ids = []
+    for start in tqdm.tqdm(range(0, len(texts), batch_size), desc="tokenize texts"):
+        text_ids.extend(tokenizer(texts[start:start + batch_size], add_special_tokens=False)["input_ids"])
+    return text_ids
+
+
+def encode_text_pairs(text_a, text_b, max_length, tokenizer, batch_size=0, dtypes=None):
+    """
+    Encodes the (text_a, text_b) pairs into preallocated (num_pairs, max_length) arrays of input ids, attention
+    mask and token type ids, the same as ``encode_plus(text_a, text_b, max_length=max_length, pad_to_max_length=True)``.
+    ``dtypes`` optionally maps "input_ids", "input_mask" and "segment_ids" to the dtypes of the arrays (int64 by
+    default).
+
+    Every distinct text is tokenized only once (a context shared by all choices of an example, an option repeated
+    in the contrastive choices, ...). The pairs are then assembled from the cached token ids with
+    ``prepare_for_model``, which adds the special tokens and does the truncation and padding of ``encode_plus``.
+    """
+    assert len(text_a) == len(text_b)
+    distinct_texts = list(dict.fromkeys(text_a + text_b))
+    text_ids = dict(zip(distinct_texts, tokenize_texts(distinct_texts, tokenizer, batch_size=batch_size)))
+    logger.info("Tokenized %d distinct texts for %d text pairs", len(distinct_texts), len(text_a))
+
+    dtypes = dtypes or {}
+    num_pairs = len(text_a)
+    input_ids = np.zeros((num_pairs, max_length), dtype=dtypes.get("input_ids", np.int64))
+    attention_mask = np.zeros((num_pairs, max_length), dtype=dtypes.get("input_mask", np.int64))
+    token_type_ids = np.zeros((num_pairs, max_length), dtype=dtypes.get("segment_ids", np.int64))
+    for pair_idx, (pair_a, pair_b) in enumerate(zip(text_a, text_b)):
+        inputs = tokenizer.prepare_for_model(
+            text_ids[pair_a],
+            text_ids[pair_b],
+            add_special_tokens=True,
+            max_length=max_length,
+            padding="max_length",
+            truncation="longest_first",
+            return_attention_mask=True,
+            return_token_type_ids=True,
+        )
+
+        assert len(inputs["input_ids"]) == max_length
+        assert len(inputs["attention_mask"]) == max_length
+        assert len(inputs["token_type_ids"]) == max_length
+
+        input_ids[pair_idx] = inputs["input_ids"]
+        attention_mask[pair_idx] = inputs["attention_mask"]
+        token_type_ids[pair_idx] = inputs["token_type_ids"]
+    return input_ids, attention_mask, token_type_ids
+
+
+def feature_cache_key(data_files, tokenizer, **conversion_args):
+    """
+    Hashes everything the features of a split depend on: the contents of the data files, the conversion
+    arguments and the tokenizer vocabulary including its added and special tokens. A feature cache named
+    after this key never has to be overwritten, since any change of its inputs gives a new key.
+    """
+    key = hashlib.sha1()
+    for data_file in data_files:
+        key.update(os.path.basename(data_file).encode("utf-8"))
+        with open(data_file, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                key.update(chunk)
+
+    key.update(json.dumps(conversion_args, sort_keys=True, default=str).encode("utf-8"))
+
+    with tempfile.TemporaryDirectory() as vocab_dir:
+        for vocab_file in sorted(tokenizer.save_vocabulary(vocab_dir)):
+            with open(vocab_file, "rb") as f:
+                key.update(f.read())
+    tokenizer_state = {
+        "tokenizer_class": type(tokenizer).__name__,
+        "added_vocab": tokenizer.get_added_vocab(),
+        "special_tokens_map": tokenizer.special_tokens_map,
+        "do_lower_case": getattr(tokenizer, "do_lower_case", None),
+        "padding_side": tokenizer.padding_side,
+    }
+    key.update(json.dumps(tokenizer_state, sort_keys=True, default=str).encode("utf-8"))
+    return key.hexdigest()[:16]
+
+
+def writer_tmp_dir(target_dir):
+    """
+    Temporary directory to write ``target_dir`` in, which no other process uses, also on other machines that share
+    the file system.
+    """
+    return "{}.tmp.{}.{}".format(target_dir, socket.gethostname(), os.getpid())
+
+
+def publish_dir(tmp_dir, target_dir, replace=True):
+    """
+    Replaces ``target_dir`` (a directory or a file) with the completely written ``tmp_dir``.
+
+    Without ``replace``, a ``target_dir`` that another process published in the meantime is kept and ``tmp_dir``
+    is discarded. The feature caches are named after their contents, so both hold the same features, and the
+    processes that already read the published one are not disturbed.
+    """
+    if not replace:
+        try:
+            os.rename(tmp_dir, target_dir)
+        except OSError:
+            if not os.path.isdir(target_dir):
+                raise
+            shutil.rmtree(tmp_dir)
+        return
+    if os.path.isdir(target_dir):
+        shutil.rmtree(target_dir)
+    elif os.path.exists(target_dir):
+        os.remove(target_dir)  # a cache in the old torch.save format
+    os.rename(tmp_dir, target_dir)
+
+
+def save_feature_arrays(cache_dir, arrays, replace=True):
+    """
+    Saves a dict of feature arrays as a columnar cache, one ``<field>.npy`` file per field in ``cache_dir``.
+    The columns are written to a temporary directory first, which is then published as ``cache_dir`` with
+    `publish_dir`.
+    """
+    tmp_dir = writer_tmp_dir(cache_dir)
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for field, array in arrays.items():
+        np.save(os.path.join(tmp_dir, field + ".npy"), np.ascontiguousarray(array))
+    publish_dir(tmp_dir, cache_dir, replace)
+
+
+def save_feature_shards(cache_dir, shards, replace=True):
+    """
+    Saves an iterable of feature array dicts as a sharded cache, one `save_feature_arrays` directory
+    ``shard_<index>`` per dict in ``cache_dir``. The shards are written one at a time, so ``shards`` can be a
+    generator that converts the examples chunk by chunk without holding all features in memory.
+    """
+    tmp_dir = writer_tmp_dir(cache_dir)
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for shard_index, arrays in enumerate(shards):
+        save_feature_arrays(os.path.join(tmp_dir, "shard_{:05d}".format(shard_index)), arrays)
+    publish_dir(tmp_dir, cache_dir, replace)
+
+
+def get_feature_shards(cache_dir):
+    """Gets the shard directories of a cache written by `save_feature_shards`, in order."""
+    return sorted(glob.glob(os.path.join(cache_dir, "shard_*")))
+
+
+def load_feature_arrays(cache_dir, fields):
+    """
+    Opens the columns ``fields`` of a cache written by `save_feature_arrays` as copy-on-write memory maps, so
+    that they can be wrapped with ``torch.from_numpy`` without reading or copying the whole file.
+    """
+    return {field: np.load(os.path.join(cache_dir, field + ".npy"), mmap_mode="c") for field in fields}
+
+
+def convert_examples_to_features_parallel(convert_fn, examples, num_workers, **kwargs):
+    """
+    Runs ``convert_fn(shard, **kwargs)`` on contiguous shards of ``examples`` in a pool of ``num_workers``
+    processes and concatenates the per-shard feature arrays in the original example order.
+    """
+    num_shards = min(len(examples), num_workers * 4)
+    shard_size = (len(examples) + num_shards - 1) // num_shards
+    shards = [examples[start:start + shard_size] for start in range(0, len(examples), shard_size)]
+    logger.info("Converting %d examples in %d shards with %d workers", len(examples), len(shards), num_workers)
+    with multiprocessing.Pool(num_workers) as pool:
+        shard_arrays = pool.map(functools.partial(convert_fn, **kwargs), shards)
+    return {field: np.concatenate([arrays[field] for arrays in shard_arrays]) for field in shard_arrays[0]}
+
+
 def convert_examples_to_features(
     examples: List[InputExample],
     label_list: List[str],
@@ -200,62 +436,71 @@ def convert_examples_to_features(
     mask_padding_with_zero=True,
     ques_type_before=1,
     whether_extend_context=False,
-) -> List[InputFeatures]:
-    """
-    Loads a data file into a list of `InputFeatures`
+    batch_size=0,
+    num_workers=1,
+    dtypes=None,
+) -> Dict[str, np.ndarray]:
     """
+    Converts the examples into a dict of feature arrays: "input_ids", "input_mask" and "segment_ids" of shape
+    (num_examples, num_choices, max_length), "label_ids" and "lengths" (the true length of the longest choice of
+    every example) of shape (num_examples,). ``dtypes`` optionally maps field names to the dtypes of the arrays
+    (int64 by default).
+
+    Each distinct context is tokenized once and every choice is built from the cached context tokens plus the
+    tokens of its option, with the same truncation and padding as ``encode_plus``. The choices are written
+    straight into the preallocated arrays.
 
+    If ``batch_size`` > 0, the texts are tokenized in batches of ``batch_size`` with a fast tokenizer.
+
+    If ``num_workers`` > 1, contiguous shards of ``examples`` are converted in a pool of ``num_workers``
+    processes and merged back in the original order, giving the same features as a single process.
+    """
+    if num_workers > 1 and len(examples) > 1:
+        return convert_examples_to_features_parallel(
+            convert_examples_to_features,
+            examples,
+            num_workers,
+            label_list=label_list,
+            max_length=max_length,
+            tokenizer=tokenizer,
+            pad_token_segment_id=pad_token_segment_id,
+            pad_on_left=pad_on_left,
+            pad_token=pad_token,
+            mask_padding_with_zero=mask_padding_with_zero,
+            ques_type_before=ques_type_before,
+            whether_extend_context=whether_extend_context,
+            batch_size=batch_size,
+            dtypes=dtypes,
+        )
+
+    dtypes = dtypes or {}
     label_map = {label: i for i, label in enumerate(label_list)}
 
-    features = []
-    all_length = list()
-    for (ex_index, example) in tqdm.tqdm(enumerate(examples), desc="convert examples to features"):
-        if ex_index % 10000 == 0:
-            logger.info("Writing example %d of %d" % (ex_index, len(examples)))
-        choices_features = []
+    num_choices = len(examples[0].endings) if examples else 0
+    text_a, text_b = [], []
+    for (ex_index, example) in enumerate(examples):
+        assert len(example.endings) == num_choices
         for ending_idx, (context, ending) in enumerate(zip(example.contexts, example.endings)):
-            text_a = context
-            if example.question.find("_") != -1:
-                # this is for cloze question
-                if ques_type_before:
-                    # text_b = example.ques_types + " " + example.question.replace("_", ending)
-                    text_b = example.question.replace("_", ending)
-                else:
-                    # text_b = example.question.replace("_", ending) + " " + example.ques_types
-                    text_b = example.question.replace("_", ending)
-            else:
-                if ques_type_before:
-                    # text_b = example.ques_types + " " + example.question + " " + ending
-                    text_b = example.question + " " + ending
-                else:
-                    # text_b = example.question + " " + example.ques_types + " " + ending
-                    text_b = example.question + " " + ending
-
+            choice_text_b = build_text_b(example.question, ending, ques_type_before)
             if whether_extend_context:
-                text_b = text_b + " " + tokenizer.additional_special_tokens[0] + " " + example.extend_context[ending_idx]
-
-            inputs = tokenizer.encode_plus(text_a, text_b, add_special_tokens=True, max_length=max_length, pad_to_max_length=True, return_attention_mask=True, return_token_type_ids=True)
-            if "num_truncated_tokens" in inputs and inputs["num_truncated_tokens"] > 0:
-                logger.info(
-                    "Attention! you are cropping tokens (swag task is ok). "
-                    "If you are training ARC and race-data and you are poping question + options,"
-                    "you need to try to use a bigger max seq length!"
-                )
-
-            input_ids, attention_mask = inputs["input_ids"], inputs['attention_mask']
-            token_type_ids = inputs["token_type_ids"]
-
-            assert len(input_ids) == max_length
-            assert len(attention_mask) == max_length
-            assert len(token_type_ids) == max_length
-
-            choices_features.append((input_ids, attention_mask, token_type_ids))
-
-        label = label_map[example.label]
-
-        features.append(InputFeatures(example_id=example.example_id, choices_features=choices_features, label=label,))
-
-    return features
+                choice_text_b = choice_text_b + " " + tokenizer.additional_special_tokens[0] + " " + example.extend_context[ending_idx]
+            text_a.append(context)
+            text_b.append(choice_text_b)
+
+    input_ids, attention_mask, token_type_ids = encode_text_pairs(
+        text_a, text_b, max_length, tokenizer, batch_size=batch_size, dtypes=dtypes
+    )
+    input_mask = attention_mask.reshape(len(examples), num_choices, max_length)
+
+    return {
+        "input_ids": input_ids.reshape(len(examples), num_choices, max_length),
+        "input_mask": input_mask,
+        "segment_ids": token_type_ids.reshape(len(examples), num_choices, max_length),
+        "label_ids": np.array(
+            [label_map[example.label] for example in examples], dtype=dtypes.get("label_ids", np.int64)
+        ),
+        "lengths": input_mask.sum(-1).max(-1).astype(dtypes.get("lengths", np.int64)),
+    }
 
 
 processors = {"race": RaceProcessor, "reclor": ReclorProcessor}
@@ -3,13 +3,23 @@ import glob
 import json
 import logging
 import os
-from typing import List
+from typing import Dict, List
 import numpy as np
 
 import tqdm
 
 from transformers import PreTrainedTokenizer
 
+from utils_multiple_choice import (
+    build_text_b,
+    convert_examples_to_features_parallel,
+    encode_text_pairs,
+    feature_cache_key,
+    get_feature_shards,
+    load_feature_arrays,
+    save_feature_arrays,
+    save_feature_shards,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -41,21 +51,6 @@ class InputExample(object):
         self.contras_extend_context = contras_extend_context
 
 
-class InputFeatures(object):
-    def __init__(self, example_id, choices_features, contras_choices_features, label, contras_label):
-        self.example_id = example_id
-        self.choices_features = [
-            {"input_ids": input_ids, "input_mask": input_mask, "segment_ids": segment_ids}
-            for input_ids, input_mask, segment_ids in choices_features
-        ]
-        self.contras_choices_features = [
-            {"contras_input_ids": input_ids, "contras_input_mask": input_mask, "contras_segment_ids": segment_ids}
-            for input_ids, input_mask, segment_ids in contras_choices_features
-        ]
-        self.label = label
-        self.contras_label = contras_label
-
-
 class DataProcessor(object):
     """Base class for data converters for multiple choice data sets."""
 
@@ -75,6 +70,10 @@ class DataProcessor(object):
         """Gets the list of labels for this data set."""
         raise NotImplementedError()
 
+    def get_data_files(self, data_dir, set_type):
+        """Gets the paths of the files the examples of ``set_type`` ("train", "dev" or "test") are read from."""
+        raise NotImplementedError()
+
 
 class RaceProcessor(DataProcessor):
     """Processor for the race-data data set."""
@@ -110,6 +109,13 @@ class RaceProcessor(DataProcessor):
         """See base class."""
         return ["0", "1", "2", "3"]
 
+    def get_data_files(self, data_dir, set_type):
+        """See base class."""
+        return sorted(
+            glob.glob(os.path.join(data_dir, set_type, "high") + "/*txt")
+            + glob.glob(os.path.join(data_dir, set_type, "middle") + "/*txt")
+        )
+
     def _read_txt(self, input_dir):
         lines = []
         files = glob.glob(input_dir + "/*txt")
@@ -176,6 +182,17 @@ class ReclorProcessor(DataProcessor):
         """See base class."""
         return [0, 1, 2, 3]
 
+    def get_data_files(self, data_dir, set_type, version=1, negative_version=1, negative_extend_version=91):
+        """See base class."""
+        prefix = {"train": "train", "dev": "val", "test": "test"}[set_type]
+        return [
+            os.path.join(data_dir, prefix + ".json"),
+            os.path.join(data_dir, prefix + "_ques_types.npy"),
+            os.path.join(data_dir, prefix + "_extended_context_cp_v" + str(version) + ".npy"),
+            os.path.join(data_dir, prefix + "_negative_context_cp_v" + str(negative_version) + ".npy"),
+            os.path.join(data_dir, prefix + "_extended_context_cp_v" + str(negative_extend_version) + ".npy"),
+        ]
+
     def _read_json(self, input_file):
         with open(input_file, "r") as f:
             lines = json.load(f)
@@ -233,101 +250,97 @@ def convert_examples_to_features(
     mask_padding_with_zero=True,
     ques_type_before=1,
     whether_extend_context=False,
-) -> List[InputFeatures]:
-    """
-    Loads a data file into a list of `InputFeatures`
+    batch_size=0,
+    num_workers=1,
+    dtypes=None,
+) -> Dict[str, np.ndarray]:
     """
+    Converts the examples into a dict of feature arrays: "input_ids", "input_mask" and "segment_ids" of shape
+    (num_examples, num_choices, max_length), their "contras_" counterparts of shape (num_examples,
+    num_contras_choices, max_length), "label_ids", "contras_label_ids" and "lengths" (the true length of the
+    longest choice or contrastive choice of every example) of shape (num_examples,). ``dtypes`` optionally maps
+    field names to the dtypes of the arrays (int64 by default); the contrastive fields use the dtypes of the
+    corresponding fields.
+
+    Each distinct context is tokenized once and every choice and contrastive choice is built from the cached
+    context tokens plus the tokens of its option, with the same truncation and padding as ``encode_plus``. The
+    choices are written straight into the preallocated arrays.
 
+    If ``batch_size`` > 0, the texts are tokenized in batches of ``batch_size`` with a fast tokenizer.
+
+    If ``num_workers`` > 1, contiguous shards of ``examples`` are converted in a pool of ``num_workers``
+    processes and merged back in the original order, giving the same features as a single process.
+    """
+    if num_workers > 1 and len(examples) > 1:
+        return convert_examples_to_features_parallel(
+            convert_examples_to_features,
+            examples,
+            num_workers,
+            label_list=label_list,
+            max_length=max_length,
+            tokenizer=tokenizer,
+            pad_token_segment_id=pad_token_segment_id,
+            pad_on_left=pad_on_left,
+            pad_token=pad_token,
+            mask_padding_with_zero=mask_padding_with_zero,
+            ques_type_before=ques_type_before,
+            whether_extend_context=whether_extend_context,
+            batch_size=batch_size,
+            dtypes=dtypes,
+        )
+
+    dtypes = dtypes or {}
     label_map = {label: i for i, label in enumerate(label_list)}
 
-    features = []
-    for (ex_index, example) in tqdm.tqdm(enumerate(examples), desc="convert examples to features"):
-        if ex_index % 10000 == 0:
-            logger.info("Writing example %d of %d" % (ex_index, len(examples)))
-        choices_features = []
+    num_choices = len(examples[0].endings) if examples else 0
+    num_contras_choices = len(examples[0].contras_endings) if examples else 0
+    text_a, text_b = [], []
+    contras_text_a, contras_text_b = [], []
+    for (ex_index, example) in enumerate(examples):
+        assert len(example.endings) == num_choices
+        assert len(example.contras_endings) == num_contras_choices
         for ending_idx, (context, ending) in enumerate(zip(example.contexts, example.endings)):
-            text_a = context
-            if example.question.find("_") != -1:
-                # this is for cloze question
-                if ques_type_before:
-                    # text_b = example.ques_types + " " + example.question.replace("_", ending)
-                    text_b = example.question.replace("_", ending)
-                else:
-                    # text_b = example.question.replace("_", ending) + " " + example.ques_types
-                    text_b = example.question.replace("_", ending)
-            else:
-                if ques_type_before:
-                    # text_b = example.ques_types + " " + example.question + " " + ending
-                    text_b = example.question + " " + ending
-                else:
-                    # text_b = example.question + " " + example.ques_types + " " + ending
-                    text_b = example.question + " " + ending
-
+            choice_text_b = build_text_b(example.question, ending, ques_type_before)
             if whether_extend_context:
-                text_b = text_b + " " + tokenizer.additional_special_tokens[0] + " " + example.extend_context[ending_idx]
-
-            inputs = tokenizer.encode_plus(text_a, text_b, add_special_tokens=True, max_length=max_length, pad_to_max_length=True, return_attention_mask=True, return_token_type_ids=True)
-            if "num_truncated_tokens" in inputs and inputs["num_truncated_tokens"] > 0:
-                logger.info(
-                    "Attention! you are cropping tokens (swag task is ok). "
-                    "If you are training ARC and race-data and you are poping question + options,"
-                    "you need to try to use a bigger max seq length!"
-                )
-
-            input_ids, attention_mask = inputs["input_ids"], inputs['attention_mask']
-            token_type_ids = inputs["token_type_ids"]
-
-            assert len(input_ids) == max_length
-            assert len(attention_mask) == max_length
-            assert len(token_type_ids) == max_length
-
-            choices_features.append((input_ids, attention_mask, token_type_ids))
-
-        label = label_map[example.label]
-
-        contras_choices_features = []
+                choice_text_b = choice_text_b + " " + tokenizer.additional_special_tokens[0] + " " + example.extend_context[ending_idx]
+            text_a.append(context)
+            text_b.append(choice_text_b)
         for ending_idx, (cont_context, cont_ending) in enumerate(zip(example.contras_contexts, example.contras_endings)):
-            text_a = cont_context
-            if example.question.find("_") != -1:
-                if ques_type_before:
-                    # text_b = example.ques_types + " " + example.question.replace("_", ending)
-                    text_b = example.question.replace("_", cont_ending)
-                else:
-                    # text_b = example.question.replace("_", ending) + " " + example.ques_types
-                    text_b = example.question.replace("_", cont_ending)
-            else:
-                if ques_type_before:
-                    # text_b = example.ques_types + " " + example.question + " " + ending
-                    text_b = example.question + " " + cont_ending
-                else:
-                    # text_b = example.question + " " + example.ques_types + " " + ending
-                    text_b = example.question + " " + cont_ending
-
+            choice_text_b = build_text_b(example.question, cont_ending, ques_type_before)
             if whether_extend_context:
-                text_b = text_b + " " + tokenizer.additional_special_tokens[0] + " " + example.contras_extend_context[ending_idx]
-
-            contras_inputs = tokenizer.encode_plus(text_a, text_b, add_special_tokens=True, max_length=max_length, pad_to_max_length=True, return_attention_mask=True, return_token_type_ids=True)
-            if "num_truncated_tokens" in contras_inputs and contras_inputs["num_truncated_tokens"] > 0:
-                logger.info(
-                    "Attention! you are cropping tokens (swag task is ok). "
-                    "If you are training ARC and race-data and you are poping question + options,"
-                    "you need to try to use a bigger max seq length!"
-                )
-
-            contras_input_ids, contras_attention_mask = contras_inputs["input_ids"], contras_inputs['attention_mask']
-            contras_token_type_ids = contras_inputs["token_type_ids"]
-
-            assert len(contras_input_ids) == max_length
-            assert len(contras_attention_mask) == max_length
-            assert len(contras_token_type_ids) == max_length
-
-            contras_choices_features.append((contras_input_ids, contras_attention_mask, contras_token_type_ids))
-
-        contras_label = example.contras_label
-
-        features.append(InputFeatures(example_id=example.example_id, choices_features=choices_features, contras_choices_features=contras_choices_features, label=label, contras_label=contras_label))
-
-    return features
+                choice_text_b = choice_text_b + " " + tokenizer.additional_special_tokens[0] + " " + example.contras_extend_context[ending_idx]
+            contras_text_a.append(cont_context)
+            contras_text_b.append(choice_text_b)
+
+    # encode the choices and the contrastive choices together, so that the contexts and options they share are
+    # only tokenized once
+    all_input_ids, all_attention_mask, all_token_type_ids = encode_text_pairs(
+        text_a + contras_text_a, text_b + contras_text_b, max_length, tokenizer, batch_size=batch_size, dtypes=dtypes
+    )
+    num_pairs = len(text_a)
+    shape = (len(examples), num_choices, max_length)
+    contras_shape = (len(examples), num_contras_choices, max_length)
+    input_mask = all_attention_mask[:num_pairs].reshape(shape)
+    contras_input_mask = all_attention_mask[num_pairs:].reshape(contras_shape)
+
+    return {
+        "input_ids": all_input_ids[:num_pairs].reshape(shape),
+        "input_mask": input_mask,
+        "segment_ids": all_token_type_ids[:num_pairs].reshape(shape),
+        "label_ids": np.array(
+            [label_map[example.label] for example in examples], dtype=dtypes.get("label_ids", np.int64)
+        ),
+        # augmented data
+        "contras_input_ids": all_input_ids[num_pairs:].reshape(contras_shape),
+        "contras_input_mask": contras_input_mask,
+        "contras_segment_ids": all_token_type_ids[num_pairs:].reshape(contras_shape),
+        "contras_label_ids": np.array(
+            [example.contras_label for example in examples], dtype=dtypes.get("contras_label_ids", np.int64)
+        ),
+        "lengths": np.maximum(input_mask.sum(-1).max(-1), contras_input_mask.sum(-1).max(-1)).astype(
+            dtypes.get("lengths", np.int64)
+        ),
+    }
 
 
 processors = {"race": RaceProcessor, "reclor": ReclorProcessor}
@@ -0,0 +1,110 @@
+import numpy as np
+import torch
+from torch import nn
+from torch.nn import CrossEntropyLoss
+
+
+def pack_sequences(lengths, capacity):
+    """
+    Assigns sequences of ``lengths`` to rows of ``capacity`` tokens with first-fit decreasing.
+    Returns the row and the start offset of every sequence, and the number of rows.
+    """
+    rows = np.zeros(len(lengths), dtype=np.int64)
+    starts = np.zeros(len(lengths), dtype=np.int64)
+    free = []
+    for index in np.argsort(-np.asarray(lengths), kind="stable"):
+        length = lengths[index]
+        for row, row_free in enumerate(free):
+            if row_free >= length:
+                break
+        else:
+            row = len(free)
+            free.append(capacity)
+        rows[index], starts[index] = row, capacity - free[row]
+        free[row] -= length
+    return rows, starts, len(free)
+
+
+class PackedMultipleChoiceModel(nn.Module):
+    """
+    Wraps a BERT, RoBERTa or ALBERT ``*ForMultipleChoice`` model so that the choices of a batch are packed into
+    as few rows as possible before they go through the encoder.
+
+    Takes the same (right-padded) inputs as the wrapped model. The unpadded choices are concatenated into rows of
+    the padded length of the batch; a block-diagonal attention mask and position ids that restart at every choice
+    keep the choices from seeing each other, so every choice gets the same hidden states as without packing. The
+    first token of every choice is then pooled and classified by the heads of the wrapped model, and the logits
+    are put back into the ``(batch_size, num_choices)`` layout.
+    """
+
+    def __init__(self, model):
+        super(PackedMultipleChoiceModel, self).__init__()
+        if model.config.model_type not in ["bert", "roberta", "albert"]:
+            raise ValueError("Sequence packing is not supported for model type {}".format(model.config.model_type))
+        self.model = model
+
+    @property
+    def config(self):
+        return self.model.config
+
+    def save_pretrained(self, save_directory):
+        self.model.save_pretrained(save_directory)
+
+    def forward(self, input_ids=None, attention_mask=None, token_type_ids=None, labels=None):
+        base_model = getattr(self.model, self.model.base_model_prefix)
+        batch_size, num_choices, length = input_ids.size()
+        input_ids = input_ids.view(-1, length)
+        lengths = attention_mask.view(-1, length).sum(-1)
+        token_type_ids = token_type_ids.view(-1, length) if token_type_ids is not None else torch.zeros_like(input_ids)
+
+        sequence_lengths = lengths.cpu().numpy()
+        rows, starts, num_rows = pack_sequences(sequence_lengths, length)
+        # for every token of every choice: its choice, its position in the choice and its place in the packed rows
+        token_sequences = np.repeat(np.arange(len(sequence_lengths)), sequence_lengths)
+        sequence_offsets = np.cumsum(sequence_lengths) - sequence_lengths
+        token_positions = np.arange(len(token_sequences)) - np.repeat(sequence_offsets, sequence_lengths)
+        token_rows = rows[token_sequences]
+        token_columns = starts[token_sequences] + token_positions
+        token_sequences, token_positions, token_rows, token_columns, rows, starts = (
+            torch.from_numpy(index).to(input_ids.device)
+            for index in (token_sequences, token_positions, token_rows, token_columns, rows, starts)
+        )
+
+        position_offset = self.config.pad_token_id + 1 if self.config.model_type == "roberta" else 0
+        packed_input_ids = input_ids.new_full((num_rows, length), self.config.pad_token_id)
+        packed_input_ids[token_rows, token_columns] = input_ids[token_sequences, token_positions]
+        packed_token_type_ids = input_ids.new_zeros((num_rows, length))
+        packed_token_type_ids[token_rows, token_columns] = token_type_ids[token_sequences, token_positions]
+        packed_position_ids = input_ids.new_full((num_rows, length), max(position_offset - 1, 0))
+        packed_position_ids[token_rows, token_columns] = token_positions + position_offset
+
+        # block-diagonal attention: a token attends to the tokens of its own choice, padding attends to anything
+        # so that its attention stays well defined
+        segments = input_ids.new_full((num_rows, length), -1)
+        segments[token_rows, token_columns] = token_sequences
+        packed_attention_mask = (segments[:, :, None] == segments[:, None, :]) | (segments[:, :, None] < 0)
+        dtype = next(self.parameters()).dtype
+        extended_attention_mask = (1.0 - packed_attention_mask[:, None, :, :].to(dtype)) * -10000.0
+
+        embedding_output = base_model.embeddings(
+            input_ids=packed_input_ids, position_ids=packed_position_ids, token_type_ids=packed_token_type_ids
+        )
+        sequence_output = base_model.encoder(
+            embedding_output,
+            extended_attention_mask,
+            head_mask=base_model.get_head_mask(None, self.config.num_hidden_layers),
+        )[0]
+
+        first_token_output = sequence_output[rows, starts]
+        if self.config.model_type == "albert":
+            pooled_output = base_model.pooler_activation(base_model.pooler(first_token_output))
+        else:
+            pooled_output = base_model.pooler(first_token_output[:, None, :])
+        logits = self.model.classifier(self.model.dropout(pooled_output))
+        reshaped_logits = logits.view(-1, num_choices)
+
+        outputs = (reshaped_logits,)
+        if labels is not None:
+            loss = CrossEntropyLoss()(reshaped_logits, labels)
+            outputs = (loss,) + outputs
+        return outputs
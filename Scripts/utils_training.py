@@ -0,0 +1,1061 @@
+import contextlib
+import copy
+import functools
+import glob
+import json
+import logging
+import math
+import os
+import queue
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from torch.utils.data import DataLoader, IterableDataset, Sampler, TensorDataset, get_worker_info
+from torch.utils.data.dataloader import default_collate
+from transformers import WEIGHTS_NAME
+
+
+logger = logging.getLogger(__name__)
+
+
+class FeatureDataset(TensorDataset):
+    """`TensorDataset` over the feature columns that also keeps the true (unpadded) length of every example."""
+
+    def __init__(self, *tensors, lengths=None):
+        super(FeatureDataset, self).__init__(*tensors)
+        self.lengths = lengths
+
+
+class StreamingFeatureDataset(IterableDataset):
+    """
+    Iterable dataset over a sharded feature cache written by `save_feature_shards`, for corpora that do not fit
+    in memory.
+
+    Every epoch, the order of the shards is shuffled with ``seed`` and the epoch set with `set_epoch`, so it is
+    the same in every process. The resulting stream of examples is cut into ``num_replicas`` contiguous ranges of
+    equal size (dropping the remainder, so that every process runs the same number of steps), and the range of
+    ``rank`` is split again between the DataLoader workers. Each worker reads its rows sequentially in chunks of
+    ``chunk_size`` and shuffles them with a buffer of ``shuffle_buffer_size`` examples.
+
+    The DataLoader batches the examples of every worker separately, so the workers get whole batches of
+    ``batch_size`` examples, which must be the batch size of the DataLoader, and only the last one a partial
+    batch. The DataLoader then yields as many batches as its length.
+    """
+
+    def __init__(
+        self,
+        shard_dirs,
+        fields,
+        shuffle_buffer_size=10000,
+        seed=0,
+        num_replicas=None,
+        rank=None,
+        chunk_size=1000,
+        batch_size=1,
+    ):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if torch.distributed.is_initialized() else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
+        self.shard_dirs = list(shard_dirs)
+        self.fields = tuple(fields)
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        # in shared memory, so that persistent DataLoader workers see the epoch set in the main process
+        self._epoch = torch.zeros((), dtype=torch.int64).share_memory_()
+        self.shard_sizes = [len(self._load_shard(shard_dir)[self.fields[0]]) for shard_dir in self.shard_dirs]
+        self.num_examples = sum(self.shard_sizes) // self.num_replicas
+
+    def _load_shard(self, shard_dir):
+        return {field: np.load(os.path.join(shard_dir, field + ".npy"), mmap_mode="r") for field in self.fields}
+
+    @property
+    def epoch(self):
+        return int(self._epoch)
+
+    def set_epoch(self, epoch):
+        self._epoch.fill_(epoch)
+
+    def _rows(self, start, stop):
+        """Yields the chunks of rows ``[start, stop)`` of the stream in the shard order of the current epoch."""
+        shard_order = np.random.RandomState(self.seed + self.epoch).permutation(len(self.shard_dirs))
+        offset = 0
+        for shard_index in shard_order:
+            shard_size = self.shard_sizes[shard_index]
+            first, last = max(start - offset, 0), min(stop - offset, shard_size)
+            offset += shard_size
+            if first >= last:
+                continue
+            arrays = self._load_shard(self.shard_dirs[shard_index])
+            for chunk_start in range(first, last, self.chunk_size):
+                chunk_stop = min(chunk_start + self.chunk_size, last)
+                yield [torch.from_numpy(np.array(arrays[field][chunk_start:chunk_stop])) for field in self.fields]
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info is not None else (1, 0)
+        num_batches = math.ceil(self.num_examples / self.batch_size)
+        first_batch, last_batch = num_batches * worker_id // num_workers, num_batches * (worker_id + 1) // num_workers
+        start = self.rank * self.num_examples + first_batch * self.batch_size
+        stop = self.rank * self.num_examples + min(last_batch * self.batch_size, self.num_examples)
+        rng = np.random.RandomState(self.seed + self.epoch + 1000 * (self.rank * num_workers + worker_id + 1))
+
+        buffer = []
+        for chunk in self._rows(start, stop):
+            for row in range(len(chunk[0])):
+                example = tuple(column[row] for column in chunk)
+                if len(buffer) < self.shuffle_buffer_size:
+                    buffer.append(example)
+                    continue
+                index = rng.randint(len(buffer))
+                yield buffer[index]
+                buffer[index] = example
+        for index in rng.permutation(len(buffer)):
+            yield buffer[index]
+
+    def __len__(self):
+        return self.num_examples
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """
+    Batch sampler that puts examples of similar length into the same batch.
+
+    With ``shuffle``, the examples are shuffled, split into mega-batches of ``batch_size * mega_batch_multiplier``
+    examples which are sorted by length and cut into batches, and the order of the batches is shuffled again. The
+    permutation only depends on ``seed`` and the epoch set with `set_epoch`, so it is the same in every process.
+    Like `DistributedSampler`, the list of batches is padded to a multiple of ``num_replicas`` by repeating its
+    first batches and every process takes every ``num_replicas``-th batch starting at ``rank``.
+
+    Without ``shuffle``, all examples are sorted by length (longest first) and cut into batches.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        shuffle=True,
+        seed=0,
+        num_replicas=None,
+        rank=None,
+        mega_batch_multiplier=50,
+    ):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if torch.distributed.is_initialized() else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.mega_batch_multiplier = mega_batch_multiplier
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        if not self.shuffle:
+            order = np.argsort(-self.lengths, kind="stable")
+            return [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = rng.permutation(len(self.lengths))
+        mega_batch_size = self.batch_size * self.mega_batch_multiplier
+        batches = []
+        for start in range(0, len(order), mega_batch_size):
+            mega_batch = order[start:start + mega_batch_size]
+            mega_batch = mega_batch[np.argsort(-self.lengths[mega_batch], kind="stable")]
+            batches.extend(mega_batch[i:i + self.batch_size] for i in range(0, len(mega_batch), self.batch_size))
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def __iter__(self):
+        batches = self._batches()
+        num_padding = len(self) * self.num_replicas - len(batches)
+        batches = batches + batches[:num_padding]
+        for batch in batches[self.rank::self.num_replicas]:
+            yield batch.tolist()
+
+    def __len__(self):
+        num_batches = int(math.ceil(len(self.lengths) / float(self.batch_size)))
+        return int(math.ceil(num_batches / float(self.num_replicas)))
+
+
+class DynamicPaddingCollator(object):
+    """
+    Collates examples of a feature dataset and cuts the padding of every group of choices down to the longest
+    choice of the batch.
+
+    ``fields`` are the names of the dataset tensors. Every ``<prefix>input_mask`` field defines a group made of
+    ``<prefix>input_ids``, ``<prefix>input_mask`` and ``<prefix>segment_ids``.
+    """
+
+    def __init__(self, fields, padding_side="right"):
+        self.padding_side = padding_side
+        self.groups = []
+        for field in fields:
+            if field.endswith("input_mask"):
+                prefix = field[:-len("input_mask")]
+                self.groups.append(
+                    (fields.index(field), [fields.index(prefix + name) for name in ("input_ids", "input_mask", "segment_ids")])
+                )
+
+    def __call__(self, examples):
+        batch = list(default_collate(examples))
+        for mask_index, indices in self.groups:
+            length = max(1, int(batch[mask_index].sum(-1).max()))
+            for index in indices:
+                if self.padding_side == "left":
+                    batch[index] = batch[index][..., -length:].contiguous()
+                else:
+                    batch[index] = batch[index][..., :length].contiguous()
+        return batch
+
+
+def dataloader_options(num_workers=0, pin_memory=False, prefetch_factor=2, persistent_workers=False):
+    """
+    Keyword arguments of a DataLoader with ``num_workers`` worker processes that each keep ``prefetch_factor``
+    batches ready, in pinned memory if ``pin_memory``. Persistent workers are kept alive between epochs.
+    """
+    options = {"num_workers": num_workers, "pin_memory": pin_memory}
+    if num_workers > 0:
+        options.update(prefetch_factor=prefetch_factor, persistent_workers=persistent_workers)
+    return options
+
+
+def prefetch_to_device(batches, device, skip=()):
+    """
+    Yields the ``batches`` as long tensors on ``device``, with None for the fields at the positions in ``skip``,
+    which are not copied.
+
+    On GPU the batches are copied on a separate stream, and the copy of the next batch is started before the
+    current batch is returned, so that it overlaps with the computation on the current batch. The copies only
+    run asynchronously to the host for batches in pinned memory.
+    """
+    stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+
+    def to_device(batch):
+        if batch is None:
+            return None
+        with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+            return tuple(
+                None if index in skip else tensor.to(device, non_blocking=True).long()
+                for index, tensor in enumerate(batch)
+            )
+
+    batches = iter(batches)
+    next_batch = to_device(next(batches, None))
+    while next_batch is not None:
+        batch = next_batch
+        if stream is not None:
+            torch.cuda.current_stream(device).wait_stream(stream)
+            for tensor in batch:
+                if tensor is not None:
+                    # the memory of the tensor must not be reused before the computation on it is done
+                    tensor.record_stream(torch.cuda.current_stream(device))
+        next_batch = to_device(next(batches, None))
+        yield batch
+
+
+def concat_choice_groups(groups, pad_value=0, padding_side="right"):
+    """
+    Concatenates groups of choices of shape ``(batch_size, num_choices, length)`` along the choice dimension,
+    padding every group with ``pad_value`` to the longest length first.
+    """
+    length = max(group.size(-1) for group in groups)
+    padded = []
+    for group in groups:
+        padding = (0, length - group.size(-1)) if padding_side == "right" else (length - group.size(-1), 0)
+        padded.append(F.pad(group, padding, value=pad_value))
+    return torch.cat(padded, dim=1)
+
+
+def grouped_multiple_choice_loss(logits, labels, group_sizes):
+    """
+    Multiple-choice head over groups with different numbers of choices that were scored in one forward pass.
+
+    The ``*ForMultipleChoice`` models score every choice independently and only view the scores as
+    ``(batch_size, num_choices)``, so the choices of all groups can go through the encoder as one batch.
+    ``logits`` are split back into groups of ``group_sizes`` choices and the cross-entropy losses of the groups
+    are summed. Returns the loss and the logits of every group.
+    """
+    group_logits = torch.split(logits, group_sizes, dim=1)
+    loss = sum(F.cross_entropy(group, group_labels) for group, group_labels in zip(group_logits, labels))
+    return loss, group_logits
+
+
+class PredictionAccumulator(object):
+    """
+    Collects the logits and labels of a training logging window in preallocated tensors on
+    ``device``, growing them by doubling when more than ``capacity`` examples are added.
+
+    Adding a batch only copies on the device, so it never synchronizes with the host. With ``distributed``,
+    `gather` combines the predictions of all processes and must be called by every process.
+    """
+
+    def __init__(self, capacity, device, distributed=False):
+        self.capacity = max(1, capacity)
+        self.device = device
+        self.distributed = distributed and torch.distributed.is_initialized()
+        self.logits = None
+        self.labels = torch.empty(self.capacity, dtype=torch.long, device=device)
+        self.count = 0
+
+    def add(self, logits, labels):
+        logits, labels = logits.detach(), labels.detach()
+        if self.logits is None:
+            self.logits = torch.empty((self.capacity, logits.size(1)), dtype=torch.float, device=self.device)
+        if self.count + len(logits) > self.capacity:
+            self._grow(max(2 * self.capacity, self.count + len(logits)))
+        self.logits[self.count:self.count + len(logits)] = logits
+        self.labels[self.count:self.count + len(labels)] = labels
+        self.count += len(logits)
+
+    def _grow(self, capacity):
+        logits = self.logits.new_empty((capacity, self.logits.size(1)))
+        labels = self.labels.new_empty(capacity)
+        logits[:self.count], labels[:self.count] = self.logits[:self.count], self.labels[:self.count]
+        self.logits, self.labels, self.capacity = logits, labels, capacity
+
+    def gather(self):
+        """Returns the logits and labels added so far (by all processes, in rank order) as numpy arrays."""
+        if self.logits is None:
+            return np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=np.int64)
+        logits, labels = self.logits[:self.count], self.labels[:self.count]
+        if self.distributed:
+            world_size = torch.distributed.get_world_size()
+            counts = [torch.zeros((), dtype=torch.long, device=self.device) for _ in range(world_size)]
+            torch.distributed.all_gather(counts, torch.tensor(self.count, device=self.device))
+            counts = [int(count) for count in counts]
+            # all_gather needs tensors of the same size, so pad every process to the largest count
+            padded_logits = self.logits.new_zeros((max(counts), logits.size(1)))
+            padded_labels = self.labels.new_zeros(max(counts))
+            padded_logits[:self.count], padded_labels[:self.count] = logits, labels
+            all_logits = [torch.empty_like(padded_logits) for _ in counts]
+            all_labels = [torch.empty_like(padded_labels) for _ in counts]
+            torch.distributed.all_gather(all_logits, padded_logits)
+            torch.distributed.all_gather(all_labels, padded_labels)
+            logits = torch.cat([rank_logits[:count] for rank_logits, count in zip(all_logits, counts)])
+            labels = torch.cat([rank_labels[:count] for rank_labels, count in zip(all_labels, counts)])
+        return logits.cpu().numpy(), labels.cpu().numpy()
+
+    def reset(self):
+        self.count = 0
+
+    def state_dict(self):
+        if self.logits is None:
+            return {"logits": None, "labels": None}
+        return {"logits": self.logits[:self.count].cpu(), "labels": self.labels[:self.count].cpu()}
+
+    def load_state_dict(self, state_dict):
+        self.reset()
+        if state_dict["logits"] is not None and len(state_dict["logits"]):
+            self.add(state_dict["logits"].to(self.device), state_dict["labels"].to(self.device))
+
+
+AMP_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def autocast(device, amp_dtype=None):
+    """Autocast context running ``device`` ops in ``amp_dtype`` ("fp16" or "bf16"), disabled if it is None."""
+    if amp_dtype is None:
+        return torch.autocast(device.type, enabled=False)
+    return torch.autocast(device.type, dtype=AMP_DTYPES[amp_dtype])
+
+
+def grad_scaler(amp_dtype=None):
+    """Loss scaler for fp16 mixed precision; bf16 has the range of fp32, so the scaler is disabled otherwise."""
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda", enabled=amp_dtype == "fp16")
+    return torch.cuda.amp.GradScaler(enabled=amp_dtype == "fp16")
+
+
+def gradient_sync(model, sync):
+    """
+    Context for the forward and backward pass of a micro-step. Unless ``sync`` is set, a DistributedDataParallel
+    ``model`` only accumulates the gradients locally, so they are reduced once by the last micro-step of a step.
+    """
+    if not sync and isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+
+class _CheckpointedLayer(object):
+    """Mixin recomputing the activations of an encoder layer in the backward pass instead of keeping them."""
+
+    def forward(self, *args, **kwargs):
+        # a shared ALBERT layer group is called several times per forward pass, one index per call
+        index = self.checkpoint_first_index + self.checkpoint_calls % self.checkpoint_calls_per_forward
+        self.checkpoint_calls += 1
+        forward = functools.partial(super(_CheckpointedLayer, self).forward, **kwargs)
+        if not (self.training and torch.is_grad_enabled()) or index % self.checkpoint_every:
+            return forward(*args)
+        return checkpoint(forward, *args, use_reentrant=False)
+
+
+_CHECKPOINTED_LAYER_CLASSES = {}
+
+
+def enable_gradient_checkpointing(model, every=1):
+    """
+    Turns on activation checkpointing for every ``every``-th layer of the encoder of a ``*ForMultipleChoice``
+    model: ``every=1`` keeps the fewest activations, larger values recompute fewer layers in the backward pass.
+
+    The classes of the layer modules are swapped for checkpointing subclasses, so the parameters, and with them
+    the saved checkpoints, are unchanged.
+    """
+    base_model = getattr(model, model.base_model_prefix)
+    encoder = getattr(base_model, "encoder", base_model)
+    layers = encoder.albert_layer_groups if hasattr(encoder, "albert_layer_groups") else encoder.layer
+    calls_per_forward = model.config.num_hidden_layers // len(layers)
+    for layer_index, layer in enumerate(layers):
+        layer_class = type(layer)
+        if layer_class not in _CHECKPOINTED_LAYER_CLASSES:
+            _CHECKPOINTED_LAYER_CLASSES[layer_class] = type(
+                "Checkpointed" + layer_class.__name__, (_CheckpointedLayer, layer_class), {}
+            )
+        layer.__class__ = _CHECKPOINTED_LAYER_CLASSES[layer_class]
+        layer.checkpoint_first_index = layer_index * calls_per_forward
+        layer.checkpoint_calls_per_forward = calls_per_forward
+        layer.checkpoint_calls = 0
+        layer.checkpoint_every = every
+    logger.info("Checkpointing every %d of %d encoder layers", every, model.config.num_hidden_layers)
+
+
+def peak_memory_mb(device):
+    """
+    Returns the peak memory in MB: on GPU the memory allocated by tensors since the last call, on CPU the peak
+    resident set size of the process, which cannot be reset.
+    """
+    if device.type == "cuda":
+        peak = torch.cuda.max_memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        return peak / 2.0 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def peak_memory_name(device):
+    """Names the value of `peak_memory_mb`, which on CPU is the peak over the lifetime of the process, not the step."""
+    return "peak_memory" if device.type == "cuda" else "lifetime_peak_memory"
+
+
+def training_flops(config, tokens, length):
+    """
+    Estimates the FLOPs of the forward and backward pass of the encoder described by ``config`` over ``tokens``
+    tokens in sequences of ``length`` tokens: the matrix multiplications of the attention and feed-forward
+    layers and the attention over the sequence, with the backward pass twice the forward pass.
+    """
+    hidden_size = config.hidden_size
+    intermediate_size = getattr(config, "intermediate_size", getattr(config, "d_inner", 4 * hidden_size))
+    flops_per_token = 8 * hidden_size ** 2 + 4 * hidden_size * intermediate_size + 4 * length * hidden_size
+    return 3 * config.num_hidden_layers * flops_per_token * tokens
+
+
+class StepStats(object):
+    """
+    Times the phases of the training steps and counts their examples and tokens, to report the time per step of
+    every phase, the throughput and the estimated FLOPs utilization of every logging window.
+
+    The phases are timed on the host, with the GPU synchronized at their end. The tokens are counted on the device
+    from the attention masks, so that counting does not wait for the GPU. ``config`` is the model config to
+    estimate the FLOPs with, ``peak_flops`` the FLOPs per second of the hardware. Every report is added to
+    ``tb_writer`` and appended as a JSON line to ``log_path``, if given. Disabled, every method returns at once.
+    """
+
+    PHASES = ("data", "forward", "backward", "optimizer", "evaluation")
+
+    def __init__(self, device, config=None, tb_writer=None, log_path=None, peak_flops=0.0, enabled=True):
+        self.device = device
+        self.config = config
+        self.tb_writer = tb_writer
+        self.log_path = log_path
+        self.peak_flops = peak_flops
+        self.enabled = enabled
+        self._disabled_phase = contextlib.nullcontext()
+        self.reset()
+
+    def reset(self):
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+        self.steps = 0
+        self.samples = 0
+        self.tokens = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.padded_tokens = 0
+        self.flops = 0.0
+        self.start = time.perf_counter()
+
+    def _synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    @contextlib.contextmanager
+    def _timed_phase(self, name):
+        start = time.perf_counter()
+        yield
+        self._synchronize()
+        self.times[name] += time.perf_counter() - start
+
+    def phase(self, name):
+        """Context timing one of the `PHASES`."""
+        if not self.enabled:
+            return self._disabled_phase
+        return self._timed_phase(name)
+
+    def timed_batches(self, batches):
+        """Iterates over ``batches``, timing the wait for every batch as the data phase."""
+        if not self.enabled:
+            return batches
+        return self._timed_batches(batches)
+
+    def _timed_batches(self, batches):
+        batches = iter(batches)
+        while True:
+            with self._timed_phase("data"):
+                batch = next(batches, None)
+            if batch is None:
+                return
+            yield batch
+
+    def add_batch(self, attention_mask, count_samples=True):
+        """
+        Counts the examples and the real and padded tokens of a ``(batch_size, num_choices, length)`` mask, only
+        the tokens without ``count_samples`` for further choices of examples that were already counted.
+        """
+        if not self.enabled:
+            return
+        if count_samples:
+            self.samples += attention_mask.size(0)
+        self.tokens += attention_mask.sum()
+        self.padded_tokens += attention_mask.numel()
+        if self.config is not None:
+            self.flops += training_flops(self.config, attention_mask.numel(), attention_mask.size(-1))
+
+    def step(self):
+        """Counts an optimizer step."""
+        if self.enabled:
+            self.steps += 1
+
+    def report(self):
+        """Returns the statistics since the last report as a dict and starts a new window."""
+        self._synchronize()
+        elapsed = time.perf_counter() - self.start
+        steps = max(self.steps, 1)
+        stats = {"{}_ms".format(name): 1000.0 * value / steps for name, value in self.times.items()}
+        stats["step_ms"] = 1000.0 * elapsed / steps
+        stats["other_ms"] = stats["step_ms"] - sum(stats["{}_ms".format(name)] for name in self.PHASES)
+        stats["samples_per_sec"] = self.samples / elapsed
+        stats["tokens_per_sec"] = self.tokens.item() / elapsed
+        stats["padded_tokens_per_sec"] = self.padded_tokens / elapsed
+        stats["padding_fraction"] = 1.0 - self.tokens.item() / max(self.padded_tokens, 1)
+        if self.config is not None:
+            stats["tflops"] = self.flops / elapsed / 1e12
+            if self.peak_flops > 0:
+                stats["mfu"] = self.flops / elapsed / self.peak_flops
+        self.reset()
+        return stats
+
+    def log(self, global_step):
+        """Reports the statistics to the TensorBoard writer and the JSON lines log."""
+        if not self.enabled:
+            return None
+        stats = self.report()
+        if self.tb_writer is not None:
+            for key, value in stats.items():
+                self.tb_writer.add_scalar("step_stats/{}".format(key), value, global_step)
+        if self.log_path is not None:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(dict(stats, global_step=global_step)) + "\n")
+        logger.info(
+            "Step stats: %.1f ms per step (data %.1f, forward %.1f, backward %.1f, optimizer %.1f, evaluation %.1f), "
+            "%.1f samples/s, %.0f tokens/s, padding %.1f%%",
+            stats["step_ms"],
+            stats["data_ms"],
+            stats["forward_ms"],
+            stats["backward_ms"],
+            stats["optimizer_ms"],
+            stats["evaluation_ms"],
+            stats["samples_per_sec"],
+            stats["tokens_per_sec"],
+            100.0 * stats["padding_fraction"],
+        )
+        return stats
+
+
+class _NoProfiler(object):
+    def start(self):
+        pass
+
+    def step(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def step_profiler(log_dir, device, start_step, num_steps, first_step=0):
+    """
+    Returns a torch.profiler that records ``num_steps`` steps after the first ``start_step`` steps, with the CPU (and
+    CUDA) activities, memory, shapes and stacks, and writes the trace to ``log_dir`` for TensorBoard. It is driven
+    by calling ``step()`` after every step, starting after ``first_step`` steps, e.g. when training is resumed,
+    which records the rest of a window that has already started. Without ``num_steps``, or when the whole window
+    has already passed, it is a profiler that does nothing.
+    """
+    if num_steps <= 0 or start_step + num_steps <= first_step:
+        return _NoProfiler()
+    num_steps -= max(first_step - start_step, 0)
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if device.type == "cuda":
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    # the step before the window warms the profiler up
+    skipped = max(start_step - first_step, 0)
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(
+            wait=max(skipped - 1, 0), warmup=min(skipped, 1), active=num_steps, repeat=1
+        ),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(log_dir),
+        record_shapes=True,
+        profile_memory=True,
+        with_stack=True,
+    )
+
+
+def _parse_cpu_list(cpu_list):
+    cpus = []
+    for cpu_range in cpu_list.strip().split(","):
+        if cpu_range:
+            first, _, last = cpu_range.partition("-")
+            cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def numa_nodes():
+    """Returns the cpus of every NUMA node, or all cpus as a single node where the topology is not known."""
+    node_dirs = sorted(glob.glob("/sys/devices/system/node/node[0-9]*"), key=lambda path: int(path.rsplit("node", 1)[1]))
+    nodes = []
+    for node_dir in node_dirs:
+        with open(os.path.join(node_dir, "cpulist")) as f:
+            nodes.append(_parse_cpu_list(f.read()))
+    return nodes or [list(range(os.cpu_count()))]
+
+
+def bind_cpu_rank(local_rank, local_world_size, binding="cores", num_threads=0):
+    """
+    Pins the process of ``local_rank`` out of the ``local_world_size`` processes on this machine to its share of
+    the cpus and sets its number of intra-op threads (``num_threads``, or one per cpu of the process if 0).
+
+    With "cores" every process gets a contiguous block of the cpus ordered by NUMA node, with "numa" every process
+    gets whole NUMA nodes, and with "none" the process is not pinned and the cpus are only shared out for the thread
+    count. The memory a process touches first is allocated on its own node. Returns the cpus of the process.
+    """
+    available = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else set(range(os.cpu_count()))
+    nodes = [node for node in ([cpu for cpu in node if cpu in available] for node in numa_nodes()) if node]
+    if binding == "numa":
+        first = local_rank * len(nodes) // local_world_size
+        last = max((local_rank + 1) * len(nodes) // local_world_size, first + 1)
+        cpus = [cpu for node in nodes[first:last] for cpu in node]
+    else:
+        ordered = [cpu for node in nodes for cpu in node]
+        per_rank = len(ordered) // local_world_size
+        if per_rank:
+            cpus = ordered[local_rank * per_rank:(local_rank + 1) * per_rank]
+        else:  # more processes than cpus
+            cpus = [ordered[local_rank % len(ordered)]]
+    if binding != "none" and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(num_threads or len(cpus))
+    return cpus
+
+
+class EvaluationEngine(object):
+    """
+    Evaluates models on a fixed multiple-choice feature dataset. It is set up on the first `run` and reused by
+    every later one, so repeated evaluations during training only pay for the forward passes.
+
+    The examples are sorted by length (longest first), cut into batches and padded to the longest choice of each
+    batch. The logits and labels are written into buffers preallocated on ``device`` at the positions of the
+    examples, so they come back in dataset order, and the loss is summed on the device, so the host only waits
+    at the end of a run. The model runs in inference mode under ``amp_dtype`` autocast; with ``data_parallel``
+    it is wrapped in one DataParallel over all GPUs, which is kept as long as the same model is evaluated.
+
+    ``batch_size`` is per device. With 0, it is sized on the first run: on GPU, the largest power of two up to
+    ``max_batch_size`` for which the longest batch fits in memory; on CPU, where larger batches only add memory
+    traffic, the largest one whose longest batch has at most ``max_cpu_tokens`` tokens.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        fields,
+        device,
+        batch_size=0,
+        max_batch_size=64,
+        max_cpu_tokens=8192,
+        padding_side="right",
+        amp_dtype=None,
+        skip=(),
+        data_parallel=False,
+        loader_options=None,
+    ):
+        self.dataset = dataset
+        self.fields = tuple(fields)
+        self.device = device
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        self.max_cpu_tokens = max_cpu_tokens
+        self.amp_dtype = amp_dtype
+        self.skip = skip
+        self.data_parallel = data_parallel
+        self.loader_options = loader_options or {}
+        self.collator = DynamicPaddingCollator(self.fields, padding_side=padding_side)
+        self.order = np.argsort(-np.asarray(dataset.lengths), kind="stable")
+        self._reset()
+
+    def _reset(self):
+        self._loader = None
+        self._positions = None
+        self._parallel_model = None
+        self._logits = None
+        self._labels = None
+        self._loss = None
+
+    def __getstate__(self):
+        # the loader and the buffers are rebuilt on the first run, e.g. in the process of an `AsyncEvaluator`
+        state = self.__dict__.copy()
+        state.update(_loader=None, _positions=None, _parallel_model=None, _logits=None, _labels=None, _loss=None)
+        return state
+
+    def __len__(self):
+        return len(self.order)
+
+    @property
+    def num_devices(self):
+        return max(1, torch.cuda.device_count()) if self.data_parallel else 1
+
+    def _model(self, model):
+        if isinstance(model, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)):
+            model = model.module
+        if not self.data_parallel:
+            return model
+        if self._parallel_model is None or self._parallel_model.module is not model:
+            self._parallel_model = torch.nn.DataParallel(model)
+        return self._parallel_model
+
+    def _forward(self, model, batch):
+        input_ids, input_mask, segment_ids, label_ids = (
+            batch[self.fields.index(field)] for field in ("input_ids", "input_mask", "segment_ids", "label_ids")
+        )
+        with autocast(self.device, self.amp_dtype):
+            loss, logits = model(
+                input_ids=input_ids, attention_mask=input_mask, token_type_ids=segment_ids, labels=label_ids
+            )[:2]
+        return loss.mean(), logits, label_ids
+
+    def _fits(self, model, batch_size):
+        batch = self.collator([self.dataset[index] for index in self.order[:batch_size * self.num_devices]])
+        try:
+            self._forward(model, next(prefetch_to_device([batch], self.device, self.skip)))
+            return True
+        except RuntimeError as error:
+            if "out of memory" not in str(error):
+                raise
+            return False
+        finally:
+            torch.cuda.empty_cache()
+
+    def _setup(self, model):
+        if not self.batch_size:
+            self.batch_size = self.max_batch_size
+            if self.device.type == "cuda":
+                while self.batch_size > 1 and not self._fits(model, self.batch_size):
+                    self.batch_size //= 2
+            else:
+                longest = self.order[0]
+                choices = self.dataset[longest][self.fields.index("input_ids")].size(0)
+                example_tokens = choices * max(1, int(self.dataset.lengths[longest]))
+                self.batch_size = max(1, min(self.max_batch_size, self.max_cpu_tokens // example_tokens))
+            logger.info("Evaluation batch size per device: %d", self.batch_size)
+        total_batch_size = self.batch_size * self.num_devices
+        batches = [self.order[start:start + total_batch_size] for start in range(0, len(self), total_batch_size)]
+        self._loader = DataLoader(
+            self.dataset, batch_sampler=[batch.tolist() for batch in batches], collate_fn=self.collator,
+            **self.loader_options
+        )
+        self._positions = [torch.from_numpy(batch).to(self.device) for batch in batches]
+        self._labels = torch.empty(len(self), dtype=torch.long, device=self.device)
+        self._loss = torch.zeros((), dtype=torch.float, device=self.device)
+
+    def run(self, model, profiler=None):
+        """
+        Evaluates ``model`` (calling ``profiler.step()`` after every batch) and returns the mean loss, and the
+        logits and labels of the examples in dataset order as numpy arrays.
+        """
+        model = self._model(model)
+        model.eval()
+        with torch.inference_mode():
+            if self._loader is None:
+                self._setup(model)
+            self._loss.zero_()
+            batches = prefetch_to_device(self._loader, self.device, self.skip)
+            for batch, positions in zip(batches, self._positions):
+                loss, logits, labels = self._forward(model, batch)
+                if self._logits is None:
+                    self._logits = torch.empty((len(self), logits.size(1)), dtype=torch.float, device=self.device)
+                self._logits[positions] = logits.float()
+                self._labels[positions] = labels
+                self._loss += loss.float() * len(positions)
+                if profiler is not None:
+                    profiler.step()
+            eval_loss = self._loss.item() / max(1, len(self))
+            return eval_loss, self._logits.cpu().numpy(), self._labels.cpu().numpy()
+
+
+def _evaluation_worker(build_model, evaluate_fn, save_fn, device, metric, best, snapshots, results):
+    model = build_model().to(device)
+    while True:
+        snapshot = snapshots.get()
+        if snapshot is None:
+            break
+        step, state_dict = snapshot
+        try:
+            model.load_state_dict(state_dict)
+            del state_dict
+            step_results = evaluate_fn(model)
+            is_best = step_results[metric] > best
+            if is_best:
+                best = step_results[metric]
+                save_fn(model, step, step_results)
+            results.put((step, step_results, is_best))
+        except Exception:
+            results.put((step, traceback.format_exc(), False))
+
+
+class AsyncEvaluator(object):
+    """
+    Evaluates snapshots of the weights in a background process, so that training does not wait for evaluation.
+
+    The worker creates its model with ``build_model()`` on ``device``, loads every snapshot, gets its results
+    with ``evaluate_fn(model)`` and calls ``save_fn(model, step, results)`` whenever ``results[metric]`` beats
+    ``best``, so the checkpoint saved is always the one that was evaluated. The three functions are pickled into
+    the worker, so they must be module-level functions or partials of them. Snapshots are evaluated in order;
+    `submit` blocks while ``max_pending`` snapshots wait, which bounds their memory.
+    """
+
+    def __init__(self, build_model, evaluate_fn, save_fn, device, metric="eval_acc", best=0.0, max_pending=2):
+        context = torch.multiprocessing.get_context("spawn")
+        self.snapshots = context.Queue(max_pending)
+        self.results = context.Queue()
+        self.process = context.Process(
+            target=_evaluation_worker,
+            args=(build_model, evaluate_fn, save_fn, device, metric, best, self.snapshots, self.results),
+            daemon=True,
+        )
+        self.process.start()
+        self.pending = 0
+
+    def _check_alive(self):
+        if not self.process.is_alive():
+            raise RuntimeError("The evaluation worker exited with code {}".format(self.process.exitcode))
+
+    def submit(self, step, model):
+        state_dict = {name: tensor.detach().to("cpu", copy=True) for name, tensor in model.state_dict().items()}
+        while True:
+            try:
+                self.snapshots.put((step, state_dict), timeout=1.0)
+                break
+            except queue.Full:
+                self._check_alive()
+        self.pending += 1
+
+    def poll(self, block=False):
+        """Returns ``(step, results, is_best)`` for every evaluation that finished since the last call."""
+        finished = []
+        while self.pending:
+            try:
+                step, step_results, is_best = self.results.get(timeout=1.0) if block else self.results.get_nowait()
+            except queue.Empty:
+                if not block:
+                    break
+                self._check_alive()
+                continue
+            self.pending -= 1
+            if not isinstance(step_results, dict):
+                raise RuntimeError("Evaluation of step {} failed:\n{}".format(step, step_results))
+            finished.append((step, step_results, is_best))
+        return finished
+
+    def close(self):
+        """Waits for the pending evaluations, stops the worker and returns their results like `poll`."""
+        finished = self.poll(block=True)
+        self.snapshots.put(None)
+        self.process.join()
+        return finished
+
+
+def to_host(obj):
+    """Copies all tensors of a nested structure of dicts, lists and tuples to host memory."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: to_host(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_host(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def get_rng_state():
+    """Returns the states of the python, numpy, torch and CUDA random number generators."""
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None:
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def load_training_state(state_dir):
+    """Loads the ``training_state.pt`` saved by `write_checkpoint` into host memory."""
+    path = os.path.join(state_dir, "training_state.pt")
+    try:
+        # the state holds the numpy and python random states, which are not plain tensors
+        return torch.load(path, map_location="cpu", weights_only=False)
+    except TypeError:  # torch < 1.13
+        return torch.load(path, map_location="cpu")
+
+
+def load_training_args(checkpoint_dir):
+    """Loads the training arguments saved with a checkpoint by `write_checkpoint`."""
+    path = os.path.join(checkpoint_dir, "training_args.bin")
+    try:
+        # the arguments are an argparse namespace, not plain tensors
+        return torch.load(path, map_location="cpu", weights_only=False)
+    except TypeError:  # torch < 1.13
+        return torch.load(path, map_location="cpu")
+
+
+def write_checkpoint(output_dir, config, state_dict, tokenizer, args, files=None, training_state=None):
+    """
+    Writes a checkpoint that ``from_pretrained`` can load: the model config and ``state_dict``, the tokenizer,
+    the training arguments and the text ``files`` (a dict of file name to content). A ``training_state`` to
+    resume training from is saved as ``training_state.pt``.
+
+    ``output_dir`` is a symbolic link to the directory of the latest checkpoint. Every checkpoint is written to a
+    new directory ``<output_dir>.ckpt-<suffix>`` next to it, and the link is then switched to that directory with
+    ``os.replace``, which is atomic: readers of ``output_dir`` see the previous or the new checkpoint, never a
+    half-written one or none. The previous directory is kept until the next checkpoint is published, so that a
+    reader that resolved the link just before the switch can finish loading; older ones are removed.
+
+    An empty real ``output_dir`` is removed before the first switch. A non-empty one (e.g. a checkpoint written by
+    an earlier version of this function) is moved to a ``.ckpt-`` directory first, so only that first switch
+    briefly leaves ``output_dir`` missing.
+    """
+    parent, name = os.path.split(output_dir.rstrip(os.sep))
+    parent = parent or os.curdir
+    os.makedirs(parent, exist_ok=True)
+    prefix = name + ".ckpt-"
+    checkpoint_dir = tempfile.mkdtemp(prefix=prefix, dir=parent)
+    config.save_pretrained(checkpoint_dir)
+    torch.save(state_dict, os.path.join(checkpoint_dir, WEIGHTS_NAME))
+    tokenizer.save_vocabulary(checkpoint_dir)
+    tokenizer.save_pretrained(checkpoint_dir)
+    torch.save(args, os.path.join(checkpoint_dir, "training_args.bin"))
+    for file_name, content in (files or {}).items():
+        with open(os.path.join(checkpoint_dir, file_name), "w") as f:
+            f.write(content)
+    if training_state is not None:
+        torch.save(training_state, os.path.join(checkpoint_dir, "training_state.pt"))
+    os.chmod(checkpoint_dir, 0o755)  # mkdtemp only gives access to the owner
+
+    link = os.path.join(parent, name)
+    previous_dir = None
+    if os.path.islink(link):
+        previous_dir = os.path.join(parent, os.readlink(link))
+    elif os.path.isdir(link) and not os.listdir(link):
+        os.rmdir(link)
+    elif os.path.isdir(link):
+        previous_dir = tempfile.mkdtemp(prefix=prefix, dir=parent)
+        os.chmod(previous_dir, 0o755)
+        os.rename(link, os.path.join(previous_dir, name))
+    tmp_link = os.path.join(parent, name + ".link-tmp")
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.basename(checkpoint_dir), tmp_link)
+    os.replace(tmp_link, link)
+
+    keep = {os.path.abspath(checkpoint_dir)}
+    if previous_dir is not None:
+        keep.add(os.path.abspath(previous_dir))
+    for directory in glob.glob(os.path.join(parent, glob.escape(prefix) + "*")):
+        if os.path.abspath(directory) not in keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints with `write_checkpoint` on a background thread. `save` only copies the weights to host
+    memory, so training continues while the checkpoint is serialized. Checkpoints are written in order, and
+    `save` blocks while ``max_pending`` of them wait, which bounds the host memory of the copies.
+    """
+
+    def __init__(self, max_pending=1):
+        self.checkpoints = queue.Queue(max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.checkpoints.get()
+            try:
+                if item is None:
+                    break
+                if self.error is None:
+                    write_checkpoint(*item)
+                    logger.info("Checkpoint written to %s", item[0])
+            except Exception as e:
+                self.error = e
+            finally:
+                self.checkpoints.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError("Writing a checkpoint failed") from self.error
+
+    def save(self, output_dir, model, tokenizer, args, files=None, training_state=None):
+        self._raise_error()
+        # the tensors keep changing in place while the checkpoint is written, so they are copied first
+        state_dict = to_host(model.state_dict())
+        training_state = to_host(training_state)
+        self.checkpoints.put((output_dir, model.config, state_dict, tokenizer, copy.copy(args), files, training_state))
+
+    def wait(self):
+        """Blocks until all checkpoints are written."""
+        self.checkpoints.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self.checkpoints.put(None)
+        self.thread.join()